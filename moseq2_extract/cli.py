@@ -141,9 +141,14 @@ This is only a debugging parameter, for cases where dilate_iterations > 1, other
     function = click.option('--tail-filter-shape', default='ellipse', type=str, help='Tail filter shape')(function)
     function = click.option('--spatial-filter-size', '-s', default=[3], type=int, help='Space prefilter kernel (median filter, must be odd)', multiple=True)(function)
     function = click.option('--temporal-filter-size', '-t', default=[0], type=int, help='Time prefilter kernel (median filter, must be odd)', multiple=True)(function)
+    function = click.option('--filter-threads', default=1, type=int, help='Number of threads for the per-frame spatial and tail filters (-1 uses all cores). \
+Each of the --parallel-sessions runs its own filter threads')(function)
     function = click.option('--chunk-overlap', default=0, type=int, help='Frames overlapped in each chunk. Useful for cable tracking')(function)
     function = click.option('--write-movie', default=True, type=bool, help='Write a results output movie including an extracted mouse')(function)
+    function = click.option('--preview-codec', default='h264', type=click.Choice(['h264', 'h264_nvenc']), help='Codec for the results output movie. h264_nvenc encodes on an NVIDIA GPU and falls back to h264 if it cannot be used')(function)
     function = click.option('--frame-dtype', default='uint8', type=click.Choice(['uint8', 'uint16']), help='Data type for processed frames')(function)
+    function = click.option('--frame-compression-level', default=4, type=click.IntRange(0, 9), help='gzip level for the extracted frames and masks. \
+Lower levels (e.g. 1) write faster but produce slightly larger files')(function)
     function = click.option('--movie-dtype', default='<i2', help='Data type for raw frames read in for extraction')(function)
     function = click.option('--pixel-format', default='gray16le', type=str, help='Pixel format for reading in .avi and .mkv videos')(function)
     function = click.option('--centroid-hampel-span', default=0, type=int, help='Hampel filter span')(function)
@@ -191,6 +196,9 @@ def extract(input_file, output_dir, num_frames, skip_completed, **config_data):
 @click.option('--cluster-type', type=click.Choice(['local', 'slurm']), default='local', help='Platform to train models on')
 @click.option('--prefix', type=str, default='', help='Batch command string to prefix model training command (slurm only).')
 @click.option("--ncpus", "-c", type=int, default=1, help="Number of cores to use in extraction")
+@click.option('--parallel-sessions', type=int, default=1, help='Number of sessions to extract in parallel (local only, capped '
+              'at the number of cores). Each session runs OpenCV and h5 compression on one thread, but keeps its own load/preview '
+              'threads, ffmpeg process and --filter-threads, and holds its own frame batches, so CPU and peak memory grow with it')
 @click.option('--memory', type=str, default="5GB", help="RAM (slurm only)")
 @click.option('--wall-time', type=str, default='3:00:00', help="Wall time (slurm only)")
 @click.option('--partition', type=str, default='short', help="Partition name (slurm only)")
@@ -222,7 +230,7 @@ def batch_extract(input_folder, output_dir, skip_completed, num_frames, extensio
     if config_data['cluster_type'] == 'local':
         # the session specific config doesn't get generated in session proc file
         # session specific config direct used in config_data dictionary in extraction from extract_command function
-        run_local_extract(to_extract, config_file, skip_completed)
+        run_local_extract(to_extract, config_file, skip_completed, n_jobs=config_data.get('parallel_sessions', 1))
     else:
         # add paramters to config
         config_data['session_config_path'] = read_yaml(config_file).get('session_config_path', '') if config_file is not None else ''
@@ -25,7 +25,7 @@ def extract_chunk(chunk, use_tracking_model=False, spatial_filter_size=(3,),
                   tracking_init_mean=None, tracking_init_cov=None,
                   tracking_init_strel=cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9)),
                   flip_classifier=None, flip_classifier_smoothing=51,
-                  frame_dtype='uint8',
+                  frame_dtype='uint8', filter_threads=1,
                   progress_bar=True, crop_size=(80, 80), true_depth=673.1,
                   centroid_hampel_span=5, centroid_hampel_sig=3,
                   angle_hampel_span=5, angle_hampel_sig=3,
@@ -62,6 +62,7 @@ def extract_chunk(chunk, use_tracking_model=False, spatial_filter_size=(3,),
     flip_classifier (str): path to pre-selected flip classifier.
     flip_classifier_smoothing (int): amount of smoothing to use for flip classifier.
     frame_dtype (str): Data type for processed frames
+    filter_threads (int): number of threads for the per-frame spatial filters in clean_frames; -1 uses all cores
     save_path: (str): Path to save extracted results
     progress_bar (bool): Display progress bar
     crop_size (tuple): size of the cropped mouse image.
@@ -110,7 +111,8 @@ def extract_chunk(chunk, use_tracking_model=False, spatial_filter_size=(3,),
                                 iters_min=iters_min,
                                 strel_min=strel_min,
                                 frame_dtype=frame_dtype,
-                                progress_bar=progress_bar)
+                                progress_bar=progress_bar,
+                                n_jobs=filter_threads)
 
     # If we need it, compute the EM parameters (for tracking in presence of occluders)
     if use_tracking_model:
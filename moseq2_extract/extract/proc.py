@@ -8,10 +8,7 @@ import joblib
 import tarfile
 import scipy.stats
 import numpy as np
-import scipy.signal
-import skimage.measure
-import scipy.interpolate
-import skimage.morphology
+import scipy.ndimage
 from copy import deepcopy
 from tqdm.auto import tqdm
 import moseq2_extract.io.video
@@ -20,11 +17,9 @@ from os.path import exists, join, dirname
 from moseq2_extract.io.image import read_image, write_image
 from moseq2_extract.util import convert_pxs_to_mm, strided_app
 
-import scipy.linalg
 import scipy.optimize
-from collections import Counter
 
-def get_flips(frames, flip_file=None, smoothing=None):
+def get_flips(frames, flip_file=None, smoothing=None, batch_size=8192):
     """
     Predict frames where mouse orientation is flipped to later correct.
 
@@ -32,6 +27,7 @@ def get_flips(frames, flip_file=None, smoothing=None):
     frames (numpy.ndarray): frames x rows x columns, cropped mouse
     flip_file (str): path to pre-trained scipy random forest classifier
     smoothing (int): kernel size for median filter smoothing of random forest probabilities
+    batch_size (int): number of frames to run through the classifier at a time
 
     Returns:
     flips (numpy.array):  array for flips
@@ -46,8 +42,11 @@ def get_flips(frames, flip_file=None, smoothing=None):
     flip_class = np.where(clf.classes_ == 1)[0]
 
     try:
-        probas = clf.predict_proba(
-            frames.reshape((-1, frames.shape[1] * frames.shape[2])))
+        # predict in batches so only batch_size flattened frames are materialized at once
+        probas = np.empty((frames.shape[0], len(clf.classes_)), 'float32')
+        for i in range(0, frames.shape[0], batch_size):
+            probas[i:i + batch_size] = clf.predict_proba(
+                frames[i:i + batch_size].reshape((-1, frames.shape[1] * frames.shape[2])))
     except ValueError:
         print('WARNING: Input crop-size is not compatible with flip classifier.')
         accepted_crop = int(math.sqrt(clf.n_features_))
@@ -56,8 +55,8 @@ def get_flips(frames, flip_file=None, smoothing=None):
         probas = np.array([[0]*len(frames), [1]*len(frames)]).T # default output; indicating no flips
 
     if smoothing:
-        for i in range(probas.shape[1]):
-            probas[:, i] = scipy.signal.medfilt(probas[:, i], smoothing)
+        # temporal median over every class column at once, zero-padded like scipy.signal.medfilt
+        probas = scipy.ndimage.median_filter(probas, size=(smoothing, 1), mode='constant', cval=0)
 
     flips = probas.argmax(axis=1) == flip_class
 
@@ -78,11 +77,14 @@ def get_largest_cc(frames, progress_bar=False):
 
     foreground_obj = np.zeros((frames.shape), 'bool')
 
+    # label buffer reused across frames
+    output = np.empty(frames.shape[1:], 'int32')
+
     for i in tqdm(range(frames.shape[0]), disable=not progress_bar, desc='Computing largest Connected Component'):
         nb_components, output, stats, centroids =\
-            cv2.connectedComponentsWithStats(frames[i], connectivity=4)
-        szs = stats[:, -1]
-        foreground_obj[i] = output == szs[1:].argmax()+1
+            cv2.connectedComponentsWithStats(frames[i], labels=output, connectivity=4, ltype=cv2.CV_32S)
+        largest = stats[1:, cv2.CC_STAT_AREA].argmax() + 1
+        np.equal(output, largest, out=foreground_obj[i])
 
     return foreground_obj
 
@@ -116,16 +118,25 @@ def get_bground_im_file(frames_file, frame_stride=500, med_scale=5, output_dir=N
             finfo = moseq2_extract.io.video.get_movie_info(frames_file, **kwargs)
 
         frame_idx = np.arange(0, finfo['nframes'], frame_stride)
-        frame_store = []
+        frame_store = None
         for i, frame in enumerate(frame_idx):
             frs = moseq2_extract.io.video.load_movie_data(frames_file,
-                                                          [int(frame)], 
-                                                          frame_size=finfo['dims'], 
-                                                          finfo=finfo, 
+                                                          [int(frame)],
+                                                          frame_size=finfo['dims'],
+                                                          finfo=finfo,
                                                           **kwargs).squeeze()
-            frame_store.append(cv2.medianBlur(frs, med_scale))
-
-        bground = np.nanmedian(frame_store, axis=0)
+            # allocate the frame stack once and blur each frame directly into it
+            if frame_store is None:
+                frame_store = np.empty((len(frame_idx),) + frs.shape, frs.dtype)
+            cv2.medianBlur(frs, med_scale, dst=frame_store[i])
+
+        # frame_store is scratch space; let the median partition it in place.
+        # depth frames mark invalid pixels with 0 rather than NaN, so only pay for
+        # nanmedian when NaNs are actually present
+        if np.issubdtype(frame_store.dtype, np.floating) and np.isnan(frame_store).any():
+            bground = np.nanmedian(frame_store, axis=0, overwrite_input=True)
+        else:
+            bground = np.median(frame_store, axis=0, overwrite_input=True)
 
         write_image(bground_path, bground, scale=True)
     else:
@@ -168,11 +179,39 @@ def threshold_chunk(chunk, min_height, max_height):
     chunk (3D np.ndarray): Updated frame chunk.
     """
 
-    chunk[chunk < min_height] = 0
-    chunk[chunk > max_height] = 0
+    # build one out-of-range mask and zero it in a single masked write
+    np.putmask(chunk, (chunk < min_height) | (chunk > max_height), 0)
 
     return chunk
 
+def _fill_holes_cv2(roi, padded=None, mask=None):
+    """
+    Fill holes in a binary ROI by flood filling the exterior from the image border.
+
+    Args:
+    roi (np.ndarray): 2D ROI mask to fill.
+    padded (np.ndarray): optional uint8 scratch buffer of shape (rows + 2, cols + 2) to reuse.
+    mask (np.ndarray): optional uint8 flood fill scratch mask of shape (rows + 4, cols + 4) to reuse.
+
+    Returns:
+    filled (np.ndarray): boolean ROI mask with interior holes filled.
+    """
+
+    # pad by 1 pixel so the flood fill seed is guaranteed to lie in the exterior
+    if padded is None:
+        padded = np.empty((roi.shape[0] + 2, roi.shape[1] + 2), 'uint8')
+    if mask is None:
+        mask = np.empty((padded.shape[0] + 2, padded.shape[1] + 2), 'uint8')
+    padded[...] = 0
+    mask[...] = 0
+    np.greater(roi, 0, out=padded[1:-1, 1:-1])
+    cv2.floodFill(padded, mask, (0, 0), 2)
+
+    # anything not reached from the border is either the ROI or a hole inside of it
+    filled = padded[1:-1, 1:-1] != 2
+
+    return filled
+
 def get_roi(depth_image,
             strel_dilate=cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)),
             dilate_iterations=0,
@@ -210,7 +249,7 @@ def get_roi(depth_image,
     rois (list): list of detected roi images.
     roi_plane (np.ndarray): computed ROI Plane using RANSAC.
     bboxes (list): list of computed bounding boxes for each respective ROI.
-    label_im (list): list of scikit-image image properties
+    label_im (np.ndarray): labelled image of candidate regions (0 is background)
     ranks (list): list of ROI ranks.
     shape_index (list): list of rank means.
     """
@@ -233,27 +272,29 @@ def get_roi(depth_image,
 
     bin_im = dist_ims < noise_tolerance
 
-    # anything < noise_tolerance from the plane is part of it
-    label_im = skimage.measure.label(bin_im)
-    region_properties = skimage.measure.regionprops(label_im)
+    # anything < noise_tolerance from the plane is part of it; label with full (8) connectivity.
+    # Wu's scan-based labeling numbers regions in raster order, like skimage.measure.label
+    nlabels, label_im, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(bin_im.astype('uint8'), 8,
+                                                                                cv2.CV_32S, cv2.CCL_WU)
+    # drop the background label
+    stats = stats[1:]
 
-    areas = np.zeros((len(region_properties),))
-    extents = np.zeros_like(areas)
-    dists = np.zeros_like(extents)
+    # get the area and extent (area / bounding box area) of each region
+    areas = stats[:, cv2.CC_STAT_AREA].astype('float64')
+    extents = areas / (stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT])
 
-    # get the max distance from the center, area and extent
+    # get the max distance from the center of each region; sqrt is monotone, so
+    # take the max over squared distances and only sqrt the per-region maxima
     center = np.array(depth_image.shape)/2
-
-    for i, props in enumerate(region_properties):
-        areas[i] = props.area
-        extents[i] = props.extent
-        tmp_dists = np.sqrt(np.sum(np.square(props.coords-center), 1))
-        dists[i] = tmp_dists.max()
+    rows, cols = np.indices(depth_image.shape)
+    center_dists_sq = np.square(rows - center[0]) + np.square(cols - center[1])
+    region_dists = np.sqrt(np.array(scipy.ndimage.maximum(center_dists_sq, label_im, index=np.arange(1, nlabels)),
+                                    dtype='float64').reshape(-1))
 
     # rank features
     ranks = np.vstack((scipy.stats.rankdata(-areas, method='max'),
                        scipy.stats.rankdata(-extents, method='max'),
-                       scipy.stats.rankdata(dists, method='max')))
+                       scipy.stats.rankdata(region_dists, method='max')))
     weight_array = np.array(bg_roi_weights, 'float32')
     shape_index = np.mean(np.multiply(ranks.astype('float32'), weight_array[:, np.newaxis]), 0).argsort()
 
@@ -261,17 +302,22 @@ def get_roi(depth_image,
     rois = []
     bboxes = []
 
+    # scratch buffers shared by every candidate region
+    roi_buf = np.empty(depth_image.shape, 'uint8')
+    fill_padded = np.empty((depth_image.shape[0] + 2, depth_image.shape[1] + 2), 'uint8')
+    fill_mask = np.empty((depth_image.shape[0] + 4, depth_image.shape[1] + 4), 'uint8')
+
     # Perform image processing on each found ROI
     for shape in shape_index:
-        roi = np.zeros_like(depth_image)
-        roi[region_properties[shape].coords[:, 0],
-            region_properties[shape].coords[:, 1]] = 1
+        np.equal(label_im, shape + 1, out=roi_buf)
         if strel_dilate is not None:
-            roi = cv2.dilate(roi, strel_dilate, iterations=dilate_iterations) # Dilate
+            cv2.dilate(roi_buf, strel_dilate, dst=roi_buf, iterations=dilate_iterations) # Dilate
         if strel_erode is not None:
-            roi = cv2.erode(roi, strel_erode, iterations=erode_iterations) # Erode
+            cv2.erode(roi_buf, strel_erode, dst=roi_buf, iterations=erode_iterations) # Erode
         if bg_roi_fill_holes:
-            roi = scipy.ndimage.morphology.binary_fill_holes(roi) # Fill Holes
+            roi = _fill_holes_cv2(roi_buf, fill_padded, fill_mask) # Fill Holes
+        else:
+            roi = roi_buf.astype(depth_image.dtype)
 
         rois.append(roi)
         bboxes.append(get_bbox(roi))
@@ -306,10 +352,12 @@ def apply_roi(frames, roi):
     """
 
     # yeah so fancy indexing slows us down by 3-5x
-    cropped_frames = frames*roi
     bbox = get_bbox(roi)
+    rows = slice(bbox[0, 0], bbox[1, 0])
+    cols = slice(bbox[0, 1], bbox[1, 1])
 
-    cropped_frames = cropped_frames[:, bbox[0, 0]:bbox[1, 0], bbox[0, 1]:bbox[1, 1]]
+    # crop before masking so the multiply only touches the bounding box
+    cropped_frames = frames[:, rows, cols] * roi[rows, cols]
     return cropped_frames
 
 
@@ -346,11 +394,119 @@ def im_moment_features(IM):
     return features
 
 
+def _rect_decomposition(strel, min_size=15):
+    """
+    Decompose a large, row-convex structuring element (e.g. an ellipse) into a union of rectangles.
+
+    Erosion (dilation) by a union of elements is the pixelwise min (max) of the erosions
+    (dilations) by each element, and OpenCV runs rectangles as separable row/column filters.
+    For large ellipses this is faster than OpenCV's full-footprint path and gives identical results.
+
+    Args:
+    strel (np.ndarray): cv2 structuring element.
+    min_size (int): smallest element size worth decomposing; below it the full footprint is faster.
+
+    Returns:
+    parts (list): (rectangle, anchor) pairs whose union is strel, or None if it should not be decomposed.
+    """
+
+    if strel is None or min(strel.shape) < min_size or np.all(strel):
+        return None
+
+    strel = strel > 0
+    center_y, center_x = strel.shape[0] // 2, strel.shape[1] // 2
+    row_widths = strel.sum(1)
+
+    parts = []
+    union = np.zeros_like(strel)
+    for width in np.unique(row_widths[row_widths > 0]):
+        rows = np.flatnonzero(row_widths >= width)
+        cols = np.flatnonzero(strel[rows].all(0))
+        if len(cols) == 0:
+            return None
+        r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        union[r0:r1, c0:c1] = True
+        parts.append((np.ones((r1 - r0, c1 - c0), 'uint8'), (int(center_x - c0), int(center_y - r0))))
+
+    # only use the decomposition when it reproduces the element exactly
+    if not np.array_equal(union, strel):
+        return None
+
+    return parts
+
+
+def _open_rect_union(frame, parts, eroded, scratch):
+    """
+    Morphological opening of frame, in place, by the union of rectangles from _rect_decomposition().
+
+    Args:
+    frame (np.ndarray): 2D frame to open in place
+    parts (list): (rectangle, anchor) pairs
+    eroded (np.ndarray): scratch buffer shaped like frame
+    scratch (np.ndarray): scratch buffer shaped like frame
+
+    Returns:
+    """
+
+    for j, (rect, anchor) in enumerate(parts):
+        cv2.erode(frame, rect, dst=eroded if j == 0 else scratch, anchor=anchor)
+        if j > 0:
+            np.minimum(eroded, scratch, out=eroded)
+
+    for j, (rect, anchor) in enumerate(parts):
+        cv2.dilate(eroded, rect, dst=frame if j == 0 else scratch, anchor=anchor)
+        if j > 0:
+            np.maximum(frame, scratch, out=frame)
+
+
+def _clean_frames_range(filtered_frames, frame_idx, prefilter_space=(3,),
+                        strel_tail=None, iters_tail=None, strel_min=None, iters_min=None,
+                        tail_parts=None):
+    """
+    Apply the per-frame spatial filters of clean_frames() in place for the given frame indices.
+
+    Args:
+    filtered_frames (np.ndarray): Frames (frames x rows x columns) to filter in place.
+    frame_idx (iterable): frame indices to process
+    prefilter_space (tuple): kernel size for spatial filtering
+    strel_tail (cv2.StructuringElement): Element for tail filtering.
+    iters_tail (int): number of iterations to run opening
+    strel_min (int): minimum kernel size
+    iters_min (int): minimum number of filtering iterations
+    tail_parts (list): rectangle decomposition of strel_tail from _rect_decomposition(), if any
+
+    Returns:
+    """
+
+    if tail_parts is not None:
+        eroded = np.empty(filtered_frames.shape[1:], filtered_frames.dtype)
+        scratch = np.empty_like(eroded)
+
+    # each filter writes straight back into its frame via dst. The iteration counts used to be
+    # passed in OpenCV's positional dst slot, which runs a single pass; that is kept here so
+    # existing extractions stay reproducible
+    for i in frame_idx:
+        frame = filtered_frames[i]
+        # Erode Frames
+        if iters_min is not None and iters_min > 0:
+            cv2.erode(frame, strel_min, dst=frame)
+        # Median Blur
+        if prefilter_space is not None and np.all(np.array(prefilter_space) > 0):
+            for j in range(len(prefilter_space)):
+                cv2.medianBlur(frame, prefilter_space[j], dst=frame)
+        # Tail Filter
+        if iters_tail is not None and iters_tail > 0:
+            if tail_parts is not None:
+                _open_rect_union(frame, tail_parts, eroded, scratch)
+            else:
+                cv2.morphologyEx(frame, cv2.MORPH_OPEN, strel_tail, dst=frame)
+
+
 def clean_frames(frames, prefilter_space=(3,), prefilter_time=None,
                  strel_tail=cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7)),
                  iters_tail=None, frame_dtype='uint8',
                  strel_min=cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5)),
-                 iters_min=None, progress_bar=False):
+                 iters_min=None, progress_bar=False, n_jobs=1):
     """
     Simple temporal and/or spatial filtering, median filter and morphological opening.
 
@@ -364,38 +520,83 @@ def clean_frames(frames, prefilter_space=(3,), prefilter_time=None,
     strel_min (int): minimum kernel size
     iters_min (int): minimum number of filtering iterations
     progress_bar (bool): display progress bar
+    n_jobs (int): number of threads to split the spatial filtering across; -1 uses all cores
 
     Returns:
     filtered_frames (numpy.ndarray): frames x rows x columns
     """
 
-    # seeing enormous speed gains w/ opencv
-    filtered_frames = frames.copy().astype(frame_dtype)
+    # seeing enormous speed gains w/ opencv. astype makes a single copy that is then filtered in place
+    filtered_frames = frames.astype(frame_dtype, order='C')
+
+    filter_kwargs = {
+        'prefilter_space': prefilter_space,
+        'strel_tail': strel_tail,
+        'iters_tail': iters_tail,
+        'strel_min': strel_min,
+        'iters_min': iters_min,
+        # large elliptical tail filters run faster as a union of separable rectangles
+        'tail_parts': _rect_decomposition(strel_tail) if iters_tail is not None and iters_tail > 0 else None
+    }
 
-    for i in tqdm(range(frames.shape[0]), disable=not progress_bar, desc='Cleaning frames'):
-        # Erode Frames
-        if iters_min is not None and iters_min > 0:
-            filtered_frames[i] = cv2.erode(filtered_frames[i], strel_min, iters_min)
-        # Median Blur
-        if prefilter_space is not None and np.all(np.array(prefilter_space) > 0):
-            for j in range(len(prefilter_space)):
-                filtered_frames[i] = cv2.medianBlur(filtered_frames[i], prefilter_space[j])
-        # Tail Filter
-        if iters_tail is not None and iters_tail > 0:
-            filtered_frames[i] = cv2.morphologyEx(filtered_frames[i], cv2.MORPH_OPEN, strel_tail, iters_tail)
+    n_jobs = joblib.effective_n_jobs(n_jobs)
+    if n_jobs == 1 or frames.shape[0] < n_jobs:
+        _clean_frames_range(filtered_frames,
+                            tqdm(range(frames.shape[0]), disable=not progress_bar, desc='Cleaning frames'),
+                            **filter_kwargs)
+    else:
+        # each thread filters a contiguous block of frames; OpenCV releases the GIL
+        frame_chunks = np.array_split(np.arange(frames.shape[0]), n_jobs)
+        joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+            joblib.delayed(_clean_frames_range)(filtered_frames, idx, **filter_kwargs) for idx in frame_chunks)
 
     # Temporal Median Filter
     if prefilter_time is not None and np.all(np.array(prefilter_time) > 0):
         for j in range(len(prefilter_time)):
-            filtered_frames = scipy.signal.medfilt(filtered_frames, [prefilter_time[j], 1, 1])
+            # same zero-padded temporal median as scipy.signal.medfilt, but without the generic n-D sort
+            filtered_frames = scipy.ndimage.median_filter(filtered_frames, size=(prefilter_time[j], 1, 1),
+                                                          mode='constant', cval=0)
 
     return filtered_frames
 
 
+def _contour_areas(cnts):
+    """
+    Compute the area of every contour at once with the shoelace formula.
+
+    Gives the same values as calling cv2.contourArea() on each contour, without a Python-level
+    call per contour (frames with noise can have hundreds of them).
+
+    Args:
+    cnts (list): contours returned by cv2.findContours()
+
+    Returns:
+    areas (np.ndarray): area of each contour
+    """
+
+    if len(cnts) == 0:
+        return np.zeros((0,))
+
+    lengths = np.fromiter((len(c) for c in cnts), 'int64', len(cnts))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    # integer vertices, so the cross products are exact
+    pts = np.concatenate(cnts).reshape(-1, 2).astype('int64')
+
+    # index of the next vertex, wrapping around to the start of each contour
+    nxt = np.arange(1, len(pts) + 1)
+    nxt[ends - 1] = starts
+
+    cross = pts[:, 0] * pts[nxt, 1] - pts[nxt, 0] * pts[:, 1]
+
+    return np.abs(np.add.reduceat(cross, starts)) / 2
+
+
 def get_frame_features(frames, frame_threshold=10, mask=np.array([]),
                        mask_threshold=-30, use_cc=False, progress_bar=False, number_of_mice=1):
     """
-    Use image moments to compute features of the largest object in the frame
+    Use image moments to compute features of the largest objects in the frame
 
     Args:
     frames (3d np.ndarray): input frames
@@ -404,9 +605,10 @@ def get_frame_features(frames, frame_threshold=10, mask=np.array([]),
     mask_threshold (int): threshold to include regions into mask.
     use_cc (bool): Use connected components.
     progress_bar (bool): Display progress bar.
+    number_of_mice (int): number of mice (largest contours) to track in each frame.
 
     Returns:
-    features (dict of lists): dictionary with simple image features
+    features_list (list of dicts): per-mouse dictionaries with simple image features
     mask (3d np.ndarray): input frame mask.
     """
 
@@ -419,18 +621,18 @@ def get_frame_features(frames, frame_threshold=10, mask=np.array([]),
         has_mask = False
         mask = np.zeros((frames.shape), 'uint8')
 
-    features_list = []
-    for k in range(number_of_mice):
-        # Pack contour features into dict
-        features = {
-            'centroid': np.full((nframes, 2), np.nan),
-            'orientation': np.full((nframes,), np.nan),
-            'axis_length': np.full((nframes, 2), np.nan)
-        }
-        features_list.append(features)
+    # Contour features for every mouse, indexed as [mouse id, frame]
+    centroids = np.full((number_of_mice, nframes, 2), np.nan)
+    orientations = np.full((number_of_mice, nframes), np.nan)
+    axis_lengths = np.full((number_of_mice, nframes, 2), np.nan)
+
+    # Features of the current frame's contours, before they are matched to mouse ids
+    frame_centroids = np.empty((number_of_mice, 2))
+    frame_orientations = np.empty((number_of_mice,))
+    frame_axis_lengths = np.empty((number_of_mice, 2))
+
+    mice_last_centroids = None
 
-    first_valid_frame = False
-    
     for i in tqdm(range(nframes), disable=not progress_bar, desc='Computing moments'):
         # Threshold frame to compute mask
         frame_mask = frames[i] > frame_threshold
@@ -448,94 +650,84 @@ def get_frame_features(frames, frame_threshold=10, mask=np.array([]),
 
         # Get contours in frame
         cnts, hierarchy = cv2.findContours(frame_mask.astype('uint8'), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        tmp = np.array([cv2.contourArea(x) for x in cnts])
+        tmp = _contour_areas(cnts)
 
         if tmp.size < number_of_mice:
             continue
 
-        # mouse_cnt = tmp.argmax() # KO: tmp contains all the found contours - if there are 4 mice, they should each show up as an item in tmp. Get the 4 highest values.
+        # tmp contains all the found contours - if there are 4 mice, they should each show up as an item in tmp.
         mouse_cnts = np.argpartition(tmp, -number_of_mice)[-number_of_mice:]
-        
-        if not first_valid_frame:
-            mice_last_centroids = []
-            mice_last_orientations = []
-            for k in range(number_of_mice):
-                mouse_cnt = mouse_cnts[k]
-                moment_feats = im_moment_features(cnts[mouse_cnt])
-                mice_last_centroids.append(moment_feats['centroid'])
-                mice_last_orientations.append(moment_feats['orientation'])
-                for key, value in moment_feats.items():
-                    features_list[k][key][i] = value
-            mice_last_centroids = np.array(mice_last_centroids)
-            mice_last_orientations = np.array(mice_last_orientations)
-            first_valid_frame = True
-            continue # skip the rest of the mouse ID sorting for the first valid frame.
-            
-        print('new frame')
-        
-        assigned_ids = []
-        if number_of_mice > 1:
-            orientation_distance_scores = np.zeros((number_of_mice, number_of_mice))
-            for k in range(number_of_mice):
-                mouse_cnt = mouse_cnts[k]
-                # Get features from contours
-                moment_feats = im_moment_features(cnts[mouse_cnt])
-                # Now we need to match the mice identities based on the features from the previous frame.
-                centroid_distance_scores = scipy.linalg.norm(mice_last_centroids - np.array(moment_feats['centroid']), axis=1) # the lower, the closer
-                centroid_distance_scores = centroid_distance_scores / np.max(centroid_distance_scores) # normalize to between 0 and 1
-                orientation_distance_scores[k, :] = np.cos(mice_last_orientations - np.array(moment_feats['orientation'])) # the higher, the closer
-                print(orientation_distance_scores)
-                similarity_scores = -centroid_distance_scores
-                id = np.argmax(similarity_scores)
-                assigned_ids.append(id)
-            duplicated_ids = [item for item, count in Counter(assigned_ids).items() if count > 1]
-            free_ids = np.array(list(set(range(number_of_mice)).difference(set(assigned_ids)).union(duplicated_ids))) # unallocated ids.
-            print("initial assigned_ids: "+str(assigned_ids))
-            print("duplicated_ids: "+str(duplicated_ids))
-            print("free_ids: "+str(free_ids))
-            # Handle more than one mouse being matched to the same id by centroid distance.
-            if len(duplicated_ids) > 0:
-                print("hi")
-                new_assigned_ids = deepcopy(assigned_ids)
-                for dup_id in duplicated_ids:
-                    # We must match those duplicates to the unallocated ids (free_ids).
-                    culprits = np.squeeze(np.argwhere(assigned_ids == dup_id))
-                    print("culprits: "+str(culprits))
-                    cost_matrix = np.zeros((len(culprits), len(free_ids)))
-                    for l in range(len(culprits)):
-                        for m in range(len(free_ids)):
-                            cost_matrix[l, m] = -orientation_distance_scores[culprits[l], free_ids[m]]
-                    print(cost_matrix)
-                    row_ind, col_ind = scipy.optimize.linear_sum_assignment(cost_matrix)
-                    assignment = np.zeros((len(culprits),), dtype=np.int)
-                    for r, c in zip(row_ind, col_ind):
-                        assignment[r] = c
-                    print("assignment: "+str(assignment))
-                    for l in range(len(culprits)):
-                        new_assigned_ids[culprits[l]] = free_ids[assignment[l]]
-                    np.delete(free_ids, assignment)
-                assigned_ids = new_assigned_ids
-            
-            print(assigned_ids)
-            
-            for k in range(number_of_mice):
-                mouse_cnt = mouse_cnts[k]
-                # Get features from contours
-                moment_feats = im_moment_features(cnts[mouse_cnt])
-                id = assigned_ids[k]
-                mice_last_centroids[id] = np.array(moment_feats['centroid'])
-                mice_last_orientations[id] = np.array(moment_feats['orientation'])
-                for key, value in moment_feats.items():
-                    features_list[id][key][i] = value
+        if number_of_mice == 1 and mice_last_centroids is not None:
+            # after the first valid frame, a single mouse is read from the first contour found
+            mouse_cnts = [0]
+
+        # Get features from contours
+        for k, mouse_cnt in enumerate(mouse_cnts):
+            moment_feats = im_moment_features(cnts[mouse_cnt])
+            frame_centroids[k] = moment_feats['centroid']
+            frame_orientations[k] = moment_feats['orientation']
+            frame_axis_lengths[k] = moment_feats['axis_length']
+
+        if mice_last_centroids is None or number_of_mice == 1:
+            # first valid frame (or a single mouse): ids follow the contour order
+            assigned_ids = np.arange(number_of_mice)
         else:
-            # number_of_mice=1.
-            moment_feats = im_moment_features(cnts[0])
-            for key, value in moment_feats.items():
-                features_list[0][key][i] = value
+            # Match the mice identities to the previous frame: each contour takes the id with the
+            # closest centroid (mice without a valid centroid are never the closest)
+            centroid_distances = np.linalg.norm(frame_centroids[:, None, :] - mice_last_centroids[None, :, :], axis=2)
+            assigned_ids = np.argmin(np.nan_to_num(centroid_distances, nan=np.inf), axis=1)
+
+            # Handle more than one mouse being matched to the same id by centroid distance: those contours
+            # are matched by orientation similarity to the contested ids and the unallocated ones
+            ids, counts = np.unique(assigned_ids, return_counts=True)
+            if np.any(counts > 1):
+                duplicated_ids = ids[counts > 1]
+                culprits = np.flatnonzero(np.isin(assigned_ids, duplicated_ids))
+                free_ids = np.union1d(np.setdiff1d(np.arange(number_of_mice), assigned_ids), duplicated_ids)
+
+                # cos of the orientation change, the higher the closer
+                orientation_scores = np.cos(mice_last_orientations[None, free_ids] - frame_orientations[culprits, None])
+                _, assignment = scipy.optimize.linear_sum_assignment(-np.nan_to_num(orientation_scores, nan=-2))
+                assigned_ids[culprits] = free_ids[assignment]
+
+        centroids[assigned_ids, i] = frame_centroids
+        orientations[assigned_ids, i] = frame_orientations
+        axis_lengths[assigned_ids, i] = frame_axis_lengths
+        mice_last_centroids = centroids[:, i]
+        mice_last_orientations = orientations[:, i]
+
+    # Pack contour features into one dict of views per mouse
+    features_list = [{
+            'centroid': centroids[k],
+            'orientation': orientations[k],
+            'axis_length': axis_lengths[k]
+        } for k in range(number_of_mice)]
 
     return features_list, mask
 
 
+def _window_bounds(center, win):
+    """
+    Get the first and last integer index of a crop window around a (sub-pixel) centroid.
+
+    Matches truncating np.arange(center - win[0], center + win[1]) to integers.
+
+    Args:
+    center (float): centroid coordinate
+    win (tuple): window extent before and after the centroid
+
+    Returns:
+    bounds (np.ndarray): first and last index of the window
+    """
+
+    start = center - win[0]
+    n = int(np.ceil(center + win[1] - start))
+    # np.arange steps with delta = (start + 1) - start, so do the same for the last element
+    last = start + (n - 1) * ((start + 1) - start)
+
+    return np.array([start, last]).astype('int16').astype('int')
+
+
 def crop_and_rotate_frames(frames, features, crop_size=(80, 80), progress_bar=False):
     """
     Crop mouse from image and orients it such that the head is pointing right
@@ -557,39 +749,62 @@ def crop_and_rotate_frames(frames, features, crop_size=(80, 80), progress_bar=Fa
 
     # Get window dimensions
     win = (crop_size[0] // 2, crop_size[1] // 2 + 1)
-    border = (crop_size[1], crop_size[1], crop_size[0], crop_size[0])
+    # offsets of the (virtual) zero border around each frame, as (top, left)
+    border = (crop_size[1], crop_size[0])
+    rows, cols = frames.shape[1:3]
 
     for i in tqdm(range(frames.shape[0]), disable=not progress_bar, desc='Rotating'):
 
         if np.any(np.isnan(features['centroid'][i])):
             continue
 
-        # Get bounded frames
-        use_frame = cv2.copyMakeBorder(frames[i], *border, cv2.BORDER_CONSTANT, 0)
-
-        # Get row and column centroids
-        rr = np.arange(features['centroid'][i, 1]-win[0],
-                       features['centroid'][i, 1]+win[1]).astype('int16')
-        cc = np.arange(features['centroid'][i, 0]-win[0],
-                       features['centroid'][i, 0]+win[1]).astype('int16')
-
-        rr = rr+crop_size[0]
-        cc = cc+crop_size[1]
+        # Get the first and last row and column of the window around the centroid
+        rr = _window_bounds(features['centroid'][i, 1], win) + crop_size[0]
+        cc = _window_bounds(features['centroid'][i, 0], win) + crop_size[1]
 
         # Ensure centroids are in bounded frame
-        if (np.any(rr >= use_frame.shape[0]) or np.any(rr < 1)
-                or np.any(cc >= use_frame.shape[1]) or np.any(cc < 1)):
+        if (rr[1] >= rows + 2 * border[0] or rr[0] < 1
+                or cc[1] >= cols + 2 * border[1] or cc[0] < 1):
             continue
 
+        # Only the window itself is zero-padded where it runs off the frame, not the whole frame
+        r0, r1 = rr - border[0]
+        c0, c1 = cc - border[1]
+        if r0 >= 0 and c0 >= 0 and r1 <= rows and c1 <= cols:
+            use_frame = frames[i, r0:r1, c0:c1]
+        else:
+            use_frame = np.zeros((r1 - r0, c1 - c0), frames.dtype)
+            use_frame[max(0, -r0):min(r1, rows) - r0, max(0, -c0):min(c1, cols) - c0] = \
+                frames[i, max(r0, 0):min(r1, rows), max(c0, 0):min(c1, cols)]
+
         # Rotate the frame such that the mouse is oriented facing east
         rot_mat = cv2.getRotationMatrix2D((crop_size[0] // 2, crop_size[1] // 2),
                                           -np.rad2deg(features['orientation'][i]), 1)
-        cropped_frames[i] = cv2.warpAffine(use_frame[rr[0]:rr[-1], cc[0]:cc[-1]],
-                                           rot_mat, (crop_size[0], crop_size[1]))
+        cropped_frames[i] = cv2.warpAffine(use_frame, rot_mat, (crop_size[0], crop_size[1]))
 
     return cropped_frames
 
 
+def _prepend_diff(x):
+    """
+    Compute the frame-to-frame difference of a 1D array, with the first element set to x[0] - x[0].
+
+    Equivalent to np.diff(np.concatenate((x[:1], x))) without the concatenated copy.
+
+    Args:
+    x (np.ndarray): 1D array to difference
+
+    Returns:
+    out (np.ndarray): differenced array, same length and dtype as x
+    """
+
+    out = np.empty_like(x)
+    np.subtract(x[:1], x[:1], out=out[:1])
+    np.subtract(x[1:], x[:-1], out=out[1:])
+
+    return out
+
+
 def compute_scalars(frames, track_features, min_height=10, max_height=100, true_depth=673.1):
     """
     Compute extracted scalars.
@@ -633,7 +848,8 @@ def compute_scalars(frames, track_features, min_height=10, max_height=100, true_
     centroid_mm_shift = convert_pxs_to_mm(track_features['centroid'] + 1, true_depth=true_depth)
 
     # Based on the centroid of the mouse, get the mm_to_px conversion
-    px_to_mm = np.abs(centroid_mm_shift - centroid_mm)
+    px_to_mm = np.subtract(centroid_mm_shift, centroid_mm, out=centroid_mm_shift)
+    np.abs(px_to_mm, out=px_to_mm)
     masked_frames = np.logical_and(frames > min_height, frames < max_height)
 
     features['centroid_x_px'] = track_features['centroid'][:, 0]
@@ -654,33 +870,77 @@ def compute_scalars(frames, track_features, min_height=10, max_height=100, true_
 
     features['angle'] = track_features['orientation']
 
-    nmask = np.sum(masked_frames, axis=(1, 2))
+    nmask = features['area_px']
 
-    for i in range(nframes):
-        if nmask[i] > 0:
-            features['height_ave_mm'][i] = np.mean(
-                frames[i, masked_frames[i]])
+    # mean height of the masked pixels in each frame, in one reduction over the chunk
+    height_sum = np.sum(frames, axis=(1, 2), where=masked_frames, dtype='float64')
+    features['height_ave_mm'] = np.divide(height_sum, nmask, out=np.zeros((nframes,)),
+                                          where=nmask > 0).astype('float32')
 
-    vel_x = np.diff(np.concatenate((features['centroid_x_px'][:1], features['centroid_x_px'])))
-    vel_y = np.diff(np.concatenate((features['centroid_y_px'][:1], features['centroid_y_px'])))
-    vel_z = np.diff(np.concatenate((features['height_ave_mm'][:1], features['height_ave_mm'])))
+    vel_x = _prepend_diff(features['centroid_x_px'])
+    vel_y = _prepend_diff(features['centroid_y_px'])
+    vel_z = _prepend_diff(features['height_ave_mm'])
+    vel_z_sq = np.square(vel_z)
 
     features['velocity_2d_px'] = np.hypot(vel_x, vel_y)
     features['velocity_3d_px'] = np.sqrt(
-        np.square(vel_x)+np.square(vel_y)+np.square(vel_z))
+        np.square(vel_x)+np.square(vel_y)+vel_z_sq)
 
-    vel_x = np.diff(np.concatenate((features['centroid_x_mm'][:1], features['centroid_x_mm'])))
-    vel_y = np.diff(np.concatenate((features['centroid_y_mm'][:1], features['centroid_y_mm'])))
+    vel_x = _prepend_diff(features['centroid_x_mm'])
+    vel_y = _prepend_diff(features['centroid_y_mm'])
 
     features['velocity_2d_mm'] = np.hypot(vel_x, vel_y)
     features['velocity_3d_mm'] = np.sqrt(
-        np.square(vel_x)+np.square(vel_y)+np.square(vel_z))
+        np.square(vel_x)+np.square(vel_y)+vel_z_sq)
 
     features['velocity_theta'] = np.arctan2(vel_y, vel_x)
 
     return features
 
 
+def _nanmedian_rows(windows):
+    """
+    Compute the NaN-ignoring median of each row of a 2D array of short windows.
+
+    Sorts each row once (NaNs sort last) and averages the middle valid elements, which avoids the
+    masked-array path np.nanmedian takes for short rows. All-NaN rows return NaN.
+
+    Args:
+    windows (np.ndarray): nwindows x window length array
+
+    Returns:
+    med (np.ndarray): median of each row
+    """
+
+    sorted_windows = np.sort(windows, axis=1)
+    nvalid = np.count_nonzero(~np.isnan(sorted_windows), axis=1)
+    rows = np.arange(sorted_windows.shape[0])
+    lo = np.maximum((nvalid - 1) // 2, 0)
+
+    return (sorted_windows[rows, lo] + sorted_windows[rows, nvalid // 2]) / 2
+
+
+def _hampel_filter_1d(x, span, sig):
+    """
+    Replace outliers of a 1D series in place with the median of a sliding window around them.
+
+    Args:
+    x (np.ndarray): 1D series (or view of a column) to filter in place
+    span (int): window length
+    sig (int): number of median absolute deviations a value can differ before being replaced
+
+    Returns:
+    """
+
+    padded = np.pad(x, (span // 2, span // 2), 'constant', constant_values=np.nan)
+    vws = strided_app(padded, span, 1)
+    med = _nanmedian_rows(vws)
+    mad = _nanmedian_rows(np.abs(vws - med[:, None]))
+    vals = np.abs(x - med)
+    fill_idx = np.where(vals > med + sig * mad)[0]
+    x[fill_idx] = med[fill_idx]
+
+
 def feature_hampel_filter(features, centroid_hampel_span=None, centroid_hampel_sig=3,
                           angle_hampel_span=None, angle_hampel_sig=3):
     """
@@ -697,33 +957,131 @@ def feature_hampel_filter(features, centroid_hampel_span=None, centroid_hampel_s
     features (dict): filtered version of input dict.
     """
     if centroid_hampel_span is not None and centroid_hampel_span > 0:
-        padded_centroids = np.pad(features['centroid'],
-                                  (((centroid_hampel_span // 2, centroid_hampel_span // 2)),
-                                   (0, 0)),
-                                  'constant', constant_values = np.nan)
         for i in range(1):
-            vws = strided_app(padded_centroids[:, i], centroid_hampel_span, 1)
-            med = np.nanmedian(vws, axis=1)
-            mad = np.nanmedian(np.abs(vws - med[:, None]), axis=1)
-            vals = np.abs(features['centroid'][:, i] - med)
-            fill_idx = np.where(vals > med + centroid_hampel_sig * mad)[0]
-            features['centroid'][fill_idx, i] = med[fill_idx]
-
-        padded_orientation = np.pad(features['orientation'],
-                                    (angle_hampel_span // 2, angle_hampel_span // 2),
-                                    'constant', constant_values = np.nan)
+            _hampel_filter_1d(features['centroid'][:, i], centroid_hampel_span, centroid_hampel_sig)
 
     if angle_hampel_span is not None and angle_hampel_span > 0:
-        vws = strided_app(padded_orientation, angle_hampel_span, 1)
-        med = np.nanmedian(vws, axis=1)
-        mad = np.nanmedian(np.abs(vws - med[:, None]), axis=1)
-        vals = np.abs(features['orientation'] - med)
-        fill_idx = np.where(vals > med + angle_hampel_sig * mad)[0]
-        features['orientation'][fill_idx] = med[fill_idx]
+        _hampel_filter_1d(features['orientation'], angle_hampel_span, angle_hampel_sig)
 
     return features
 
 
+def _fill_nans_nearest(v):
+    """
+    Replace NaNs in each column with the nearest non-NaN value in time, in place.
+
+    Matches scipy.interpolate.interp1d(kind='nearest', fill_value='extrapolate'): ties go to
+    the earlier frame and NaNs past either end take the first/last valid value. Columns
+    sharing the same NaN frames are filled together; all-NaN columns are left untouched.
+
+    Args:
+    v (np.ndarray): frames x columns array to fill
+
+    Returns:
+    """
+
+    nans = np.isnan(v)
+    if not nans.any():
+        return
+
+    # group columns by NaN pattern (features are usually all missing on the same frames)
+    _, group_ids = np.unique(nans.T, axis=0, return_inverse=True)
+    group_ids = group_ids.ravel()
+    groups = [np.flatnonzero(group_ids == g) for g in range(group_ids.max() + 1)]
+
+    for cols in groups:
+        col_nans = nans[:, cols[0]]
+        valid_idx = np.flatnonzero(~col_nans)
+        if valid_idx.size == 0 or valid_idx.size == len(v):
+            continue
+        nan_idx = np.flatnonzero(col_nans)
+
+        # index of the nearest valid frame, found by bisecting the midpoints between valid frames
+        nearest = np.searchsorted((valid_idx[1:] + valid_idx[:-1]) / 2, nan_idx, side='left')
+        v[np.ix_(nan_idx, cols)] = v[np.ix_(valid_idx[nearest], cols)]
+
+
+def _pack_features(features, dtype=None):
+    """
+    Stack a features dict into one contiguous frames x columns array.
+
+    Args:
+    features (dict): dictionary of per-frame feature arrays (1D or 2D)
+    dtype (str): dtype of the packed array; defaults to the features' common dtype
+
+    Returns:
+    mat (np.ndarray): frames x columns array holding every feature
+    slices (dict): feature name mapped to its column slice in mat
+    """
+
+    nframes = len(next(iter(features.values())))
+
+    slices = {}
+    col = 0
+    for k, v in features.items():
+        width = int(np.prod(v.shape[1:]))
+        slices[k] = slice(col, col + width)
+        col += width
+
+    if dtype is None:
+        dtype = np.result_type(*features.values())
+
+    mat = np.empty((nframes, col), dtype=dtype)
+    for k, v in features.items():
+        mat[:, slices[k]] = v.reshape(nframes, -1)
+
+    return mat, slices
+
+
+def _unpack_features(mat, slices, features):
+    """
+    Copy the columns of a packed feature array back into the features dict's arrays, in place.
+
+    Args:
+    mat (np.ndarray): frames x columns array from _pack_features()
+    slices (dict): feature name mapped to its column slice in mat
+    features (dict): dictionary of per-frame feature arrays to update
+
+    Returns:
+    features (dict): the updated features dict
+    """
+
+    for k, v in features.items():
+        v[...] = mat[:, slices[k]].reshape(v.shape)
+
+    return features
+
+
+def _ema_smooth(mat, weights):
+    """
+    Apply the likelihood-weighted exponential smoother in place along the first (frame) axis,
+    first forwards and then backwards in time.
+
+    Args:
+    mat (np.ndarray): frames x features array to smooth
+    weights (np.ndarray): per-frame weight given to the current frame (the neighboring frame gets 1 - weight)
+
+    Returns:
+    """
+
+    neighbor = np.empty(mat.shape[1:], dtype=mat.dtype)
+    weights = np.asarray(weights, dtype=mat.dtype)[:, None]
+    complement = 1 - weights
+
+    # (1 - smoother) * mat[i - 1] + smoother * mat[i], for all features at once; each sweep
+    # only reads mat[i] before overwriting it, so the smoother * mat[i] terms are taken in one pass
+    mat[2:] *= weights[2:]
+    for i in range(2, len(weights)):
+        np.multiply(mat[i - 1], complement[i], out=neighbor)
+        mat[i] += neighbor
+
+    # (1 - smoother) * mat[i + 1] + smoother * mat[i]
+    mat[:-1] *= weights[:-1]
+    for i in reversed(range(len(weights) - 1)):
+        np.multiply(mat[i + 1], complement[i], out=neighbor)
+        mat[i] += neighbor
+
+
 def model_smoother(features, ll=None, clips=(-300, -125)):
     """
     Apply spatial feature filtering.
@@ -740,44 +1098,19 @@ def model_smoother(features, ll=None, clips=(-300, -125)):
     if ll is None or clips is None or (clips[0] >= clips[1]):
         return features
 
-    ave_ll = np.zeros((ll.shape[0], ))
-    for i, ll_frame in enumerate(ll):
+    max_mu = clips[1]
+    min_mu = clips[0]
 
-        max_mu = clips[1]
-        min_mu = clips[0]
+    # mean log-likelihood of each frame, rescaled to [0, 1] between the clips
+    ave_ll = ll.reshape(ll.shape[0], -1).mean(axis=1)
+    ave_ll -= min_mu
+    ave_ll /= (max_mu - min_mu)
+    ave_ll = np.clip(ave_ll, 0, 1).astype('float32')
 
-        smoother = np.mean(ll[i])
-        smoother -= min_mu
-        smoother /= (max_mu - min_mu)
+    # fill and smooth every feature column together rather than key by key; float32 is the
+    # precision the scalars are stored at and halves the memory traffic of the recurrence
+    mat, slices = _pack_features(features, dtype='float32')
+    _fill_nans_nearest(mat)
+    _ema_smooth(mat, ave_ll)
 
-        smoother = np.clip(smoother, 0, 1)
-        ave_ll[i] = smoother
-
-    for k, v in features.items():
-        nans = np.isnan(v)
-        ndims = len(v.shape)
-        xvec = np.arange(len(v))
-        if nans.any():
-            if ndims == 2:
-                for i in range(v.shape[1]):
-                    f = scipy.interpolate.interp1d(xvec[~nans[:, i]], v[~nans[:, i], i],
-                                                   kind='nearest', fill_value='extrapolate')
-                    fill_vals = f(xvec[nans[:, i]])
-                    features[k][xvec[nans[:, i]], i] = fill_vals
-            else:
-                f = scipy.interpolate.interp1d(xvec[~nans], v[~nans],
-                                               kind='nearest', fill_value='extrapolate')
-                fill_vals = f(xvec[nans])
-                features[k][nans] = fill_vals
-
-    for i in range(2, len(ave_ll)):
-        smoother = ave_ll[i]
-        for k, v in features.items():
-            features[k][i] = (1 - smoother) * v[i - 1] + smoother * v[i]
-
-    for i in reversed(range(len(ave_ll) - 1)):
-        smoother = ave_ll[i]
-        for k, v in features.items():
-            features[k][i] = (1 - smoother) * v[i + 1] + smoother * v[i]
-
-    return features
\ No newline at end of file
+    return _unpack_features(mat, slices, features)
\ No newline at end of file
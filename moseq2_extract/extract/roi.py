@@ -75,6 +75,10 @@ def plane_ransac(depth_image, bg_roi_depth_range=(650, 750), iters=1000,
 
     npoints = np.sum(use_points)
 
+    # distance and inlier buffers are reused by every iteration
+    dist = np.empty((coords.shape[0],))
+    inliers = np.empty((coords.shape[0],), dtype='bool')
+
     for _ in tqdm(range(iters), disable=not progress_bar, desc='Finding plane'):
 
         sel = coords[np.random.choice(coords.shape[0], 3, replace=True)]
@@ -83,9 +87,10 @@ def plane_ransac(depth_image, bg_roi_depth_range=(650, 750), iters=1000,
         if np.all(np.isnan(tmp_plane)):
             continue
 
-        dist = np.abs(np.dot(coords, tmp_plane[:3])+tmp_plane[3])
-        inliers = dist < noise_tolerance
-        ninliers = np.sum(inliers)
+        np.dot(coords, tmp_plane[:3], out=dist)
+        dist += tmp_plane[3]
+        np.abs(dist, out=dist)
+        ninliers = np.count_nonzero(np.less(dist, noise_tolerance, out=inliers))
 
         if ((ninliers/npoints) > in_ratio and ninliers > best_num and np.mean(dist) < best_dist):
             best_dist = np.mean(dist)
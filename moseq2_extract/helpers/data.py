@@ -286,6 +286,26 @@ def handle_extract_metadata(input_file, dirname):
     return acquisition_metadata, timestamps, tar
 
 
+def _frame_chunks(nframes, frame_shape, dtype, max_bytes=2**20):
+    """
+    Chunk shape for per-frame datasets: whole frames, as many as fit in max_bytes.
+
+    Args:
+    nframes (int): number of frames in the dataset
+    frame_shape (tuple): (rows, columns) of each frame
+    dtype (str): dataset data type
+    max_bytes (int): upper bound on the size of one chunk
+
+    Returns:
+    chunks (tuple): chunk shape to pass to h5py's create_dataset
+    """
+
+    frame_bytes = np.dtype(dtype).itemsize * int(np.prod(frame_shape))
+    nchunk_frames = int(np.clip(max_bytes // frame_bytes, 1, max(nframes, 1)))
+
+    return (nchunk_frames, *frame_shape)
+
+
 # extract h5 helper function
 def create_extract_h5(h5_file, acquisition_metadata, config_data, status_dict, scalars_attrs,
                       nframes, roi, bground_im, first_frame, first_frame_idx, last_frame_idx, **kwargs):
@@ -319,24 +339,32 @@ def create_extract_h5(h5_file, acquisition_metadata, config_data, status_dict, s
         h5_file.create_dataset('timestamps', compression='gzip', data=config_data['timestamps'][first_frame_idx:last_frame_idx])
         h5_file['timestamps'].attrs['description'] = "Depth video timestamps"
 
+    # Frame datasets are chunked by whole frames so each batch write covers complete chunks
+    # (plus at most one partial chunk at each end); lower gzip levels (e.g. 1) write the
+    # mostly-zero crops much faster for slightly larger files than the default level 4
+    crop_size = tuple(config_data['crop_size'][:2])
+    frame_compression = {'compression': 'gzip',
+                         'compression_opts': config_data.get('frame_compression_level', 4)}
+
     # Cropped Frames
-    h5_file.create_dataset('frames', (nframes, config_data['crop_size'][0], config_data['crop_size'][1]),
-                     config_data['frame_dtype'], compression='gzip')
+    h5_file.create_dataset('frames', (nframes, *crop_size), config_data['frame_dtype'],
+                           chunks=_frame_chunks(nframes, crop_size, config_data['frame_dtype']),
+                           **frame_compression)
     h5_file['frames'].attrs['description'] = ('3D Numpy array of depth frames (nframes x w x h).' +
                                               ' Depth values are in mm.')
     # Frame Masks for EM Tracking
+    mask_dtype = 'float32' if config_data['use_tracking_model'] else 'bool'
+    h5_file.create_dataset('frames_mask', (nframes, *crop_size), mask_dtype,
+                           chunks=_frame_chunks(nframes, crop_size, mask_dtype), **frame_compression)
     if config_data['use_tracking_model']:
-        h5_file.create_dataset('frames_mask', (nframes, config_data['crop_size'][0], config_data['crop_size'][1]), 'float32',
-                         compression='gzip')
         h5_file['frames_mask'].attrs['description'] = 'Log-likelihood values from the tracking model (nframes x w x h)'
     else:
-        h5_file.create_dataset('frames_mask', (nframes, config_data['crop_size'][0], config_data['crop_size'][1]), 'bool',
-                         compression='gzip')
         h5_file['frames_mask'].attrs['description'] = 'Boolean mask, false=not mouse, true=mouse'
 
     # Flip Classifier
     if config_data['flip_classifier'] is not None:
-        h5_file.create_dataset('metadata/extraction/flips', (nframes,), 'bool', compression='gzip')
+        h5_file.create_dataset('metadata/extraction/flips', (nframes,), 'bool', compression='gzip',
+                               chunks=(max(min(config_data.get('chunk_size', nframes), nframes), 1),))
         h5_file['metadata/extraction/flips'].attrs['description'] = 'Output from flip classifier, false=no flip, true=flip'
 
     # True Depth
@@ -2,16 +2,78 @@
 Extraction-helper utility functions.
 """
 
+import cv2
+import zlib
+import warnings
 import numpy as np
 import ruamel.yaml as yaml
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from os.path import exists, basename, dirname, join, abspath
-from os import makedirs, system
+from os import makedirs, system, cpu_count
 from tqdm.auto import tqdm
 from moseq2_extract.extract.extract import extract_chunk
 from moseq2_extract.util import read_yaml
 from moseq2_extract.io.video import load_movie_data, write_frames_preview
 from moseq2_extract.helpers.data import check_completion_status
 
+def _write_frames_direct(dset, frame_range, data):
+    """
+    Write a contiguous block of frames to a gzip-compressed h5 dataset, compressing the chunks
+    that the block fully covers in parallel and writing them with write_direct_chunk.
+
+    HDF5's gzip filter stores plain zlib streams, so compressing with zlib here produces the
+    same file contents without going through the serial filter pipeline. Partially covered
+    chunks at either end, and datasets without whole-frame chunks filtered by gzip alone
+    (no shuffle, checksum or scale-offset filters), use a regular write.
+
+    Args:
+    dset (h5py.Dataset): dataset to write to
+    frame_range (slice): contiguous frame slice to write
+    data (np.ndarray): frames to write (len(data) == frame_range.stop - frame_range.start)
+
+    Returns:
+    """
+
+    chunks = dset.chunks
+    if (not isinstance(frame_range, slice) or dset.compression != 'gzip'
+            or dset.shuffle or dset.fletcher32 or dset.scaleoffset is not None
+            or chunks is None or chunks[1:] != dset.shape[1:]):
+        dset[frame_range] = data
+        return
+
+    start, stop = frame_range.start, frame_range.stop
+    chunk_len = chunks[0]
+    first = -(-start // chunk_len) * chunk_len
+    last = (stop // chunk_len) * chunk_len
+
+    if last <= first:
+        dset[frame_range] = data
+        return
+
+    # partially covered chunks at the edges go through the filter pipeline
+    if first > start:
+        dset[start:first] = data[:first - start]
+    if stop > last:
+        dset[last:stop] = data[last - start:]
+
+    block = np.ascontiguousarray(data[first - start:last - start], dtype=dset.dtype)
+    level = dset.compression_opts
+    bufs = [block[i:i + chunk_len] for i in range(0, len(block), chunk_len)]
+
+    # zlib releases the GIL while compressing; use no more threads than OpenCV may, so session
+    # workers of run_local_extract (OpenCV limited to one thread) compress serially
+    n_workers = min(len(bufs), cpu_count() or 1, max(cv2.getNumThreads(), 1))
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            compressed = list(pool.map(lambda b: zlib.compress(b, level), bufs))
+    else:
+        compressed = [zlib.compress(b, level) for b in bufs]
+
+    zeros = (0,) * (dset.ndim - 1)
+    for i, buf in enumerate(compressed):
+        dset.id.write_direct_chunk((first + i * chunk_len, *zeros), buf)
+
+
 def write_extracted_chunk_to_h5(h5_file, results, config_data, scalars, frame_range, offset):
     """
 
@@ -28,13 +90,18 @@ def write_extracted_chunk_to_h5(h5_file, results, config_data, scalars, frame_ra
     Returns:
     """
 
+    # A contiguous range is written as one hyperslab; h5py treats a range object
+    # as a fancy (point-by-point) selection, which is much slower for every dataset below
+    if isinstance(frame_range, range) and frame_range.step == 1:
+        frame_range = slice(frame_range.start, frame_range.stop)
+
     # Writing computed scalars to h5 file
     for scalar in scalars:
         h5_file[f'scalars/{scalar}'][frame_range] = results['scalars'][scalar][offset:]
 
     # Writing frames and mask to h5
-    h5_file['frames'][frame_range] = results['depth_frames'][offset:]
-    h5_file['frames_mask'][frame_range] = results['mask_frames'][offset:]
+    _write_frames_direct(h5_file['frames'], frame_range, results['depth_frames'][offset:])
+    _write_frames_direct(h5_file['frames_mask'], frame_range, results['mask_frames'][offset:])
 
     # Writing flip classifier results to h5
     if config_data['flip_classifier']:
@@ -56,9 +123,9 @@ def set_tracking_model_parameters(results, min_height, tracking_model_ll_clip, c
     tracking_init_cov (float): covariance value for EM Tracking
     """
 
-    # Thresholding and clipping EM-tracked frame mask data
-    results['mask_frames'][results['depth_frames'] < min_height] = tracking_model_ll_clip
-    results['mask_frames'][results['mask_frames'] < tracking_model_ll_clip] = tracking_model_ll_clip
+    # Thresholding and clipping EM-tracked frame mask data, in place
+    np.putmask(results['mask_frames'], results['depth_frames'] < min_height, tracking_model_ll_clip)
+    np.maximum(results['mask_frames'], tracking_model_ll_clip, out=results['mask_frames'])
 
     # Updating EM tracking estimators
     tracking_init_mean = results['parameters']['mean'][-(chunk_overlap + 1)]
@@ -79,14 +146,25 @@ def make_output_movie(results, config_data, offset=0):
     output_movie (numpy.ndarray): output movie to write to mp4 file.
     """
 
-    # Create empty array for output movie with filtered video and cropped mouse on the top left
-    nframes, rows, cols = results['chunk'][offset:].shape
+    depth_frames = results['depth_frames'][offset:]
+    chunk = results['chunk'][offset:]
+
+    # 8-bit extractions are composed in 8 bits (half the memory traffic of uint16); the preview
+    # writer converts each frame to float32 before colormapping, so the video is the same
+    if depth_frames.dtype == np.uint8 and chunk.dtype == np.uint8:
+        movie_dtype = 'uint8'
+    else:
+        movie_dtype = 'uint16'
+
+    # Create empty array for output movie with filtered video and cropped mouse on the top left.
+    # np.zeros gets pre-zeroed pages, so only the two tiles below are actually written
+    nframes, rows, cols = chunk.shape
     output_movie = np.zeros((nframes, rows + config_data['crop_size'][0], cols + config_data['crop_size'][1]),
-                            'uint16')
+                            movie_dtype)
 
     # Populating array with filtered and cropped videos
-    output_movie[:, :config_data['crop_size'][0], :config_data['crop_size'][1]] = results['depth_frames'][offset:]
-    output_movie[:, config_data['crop_size'][0]:, config_data['crop_size'][1]:] = results['chunk'][offset:]
+    output_movie[:, :config_data['crop_size'][0], :config_data['crop_size'][1]] = depth_frames
+    output_movie[:, config_data['crop_size'][0]:, config_data['crop_size'][1]:] = chunk
 
     return output_movie
 
@@ -116,54 +194,106 @@ def process_extract_batches(input_file, config_data, bground_im, roi,
     tracking_init_mean = config_data.pop('tracking_init_mean', None)
     tracking_init_cov = config_data.pop('tracking_init_cov', None)
 
-    for i, frame_range in enumerate(tqdm(frame_batches, desc='Processing batches')):
-        raw_chunk = load_movie_data(input_file,
-                                    frame_range,
-                                    frame_size=bground_im.shape[::-1],
-                                    **config_data)
-
-        offset = config_data['chunk_overlap'] if i > 0 else 0
-
-        # Get crop-rotated frame batch
-        # number_of_mice = config_data['number_of_mice']
-        results_list = extract_chunk(**config_data,
-                                **str_els,
-                                chunk=raw_chunk,
-                                roi=roi,
-                                bground=bground_im,
-                                tracking_init_mean=tracking_init_mean,
-                                tracking_init_cov=tracking_init_cov,
-                                number_of_mice=4
-                                )
-
-        # MultiAnimal: Testing on one mouse at a time first, id 0.
-        results = results_list[0]
+    frame_dims = bground_im.shape[::-1]
+
+    # merge the per-session arguments once; only the tracking init changes between batches
+    # MultiAnimal: number_of_mice = config_data['number_of_mice']
+    extract_kwargs = {**config_data,
+                      **str_els,
+                      'roi': roi,
+                      'bground': bground_im,
+                      'tracking_init_mean': tracking_init_mean,
+                      'tracking_init_cov': tracking_init_cov,
+                      'number_of_mice': 4}
+
+    def load_batch(frame_range):
+        return load_movie_data(input_file,
+                               frame_range,
+                               frame_size=frame_dims,
+                               **config_data)
+
+    # Reading the depth video and encoding the preview run on their own threads so they
+    # overlap with extracting the current batch (numpy, OpenCV, h5py and pipe writes release the GIL)
+    with ThreadPoolExecutor(max_workers=1) as load_pool, ThreadPoolExecutor(max_workers=1) as preview_pool:
+        next_chunk = load_pool.submit(load_batch, frame_batches[0]) if len(frame_batches) > 0 else None
+        preview_future = None
+
+        for i, frame_range in enumerate(tqdm(frame_batches, desc='Processing batches')):
+            raw_chunk = next_chunk.result()
+
+            # Prefetch the next batch while this one is extracted
+            if i + 1 < len(frame_batches):
+                next_chunk = load_pool.submit(load_batch, frame_batches[i + 1])
+
+            offset = config_data['chunk_overlap'] if i > 0 else 0
+
+            # Get crop-rotated frame batch
+            results_list = extract_chunk(chunk=raw_chunk, **extract_kwargs)
+            # the background-subtracted copy lives in the results, so the raw batch can go
+            del raw_chunk
+
+            # MultiAnimal: Testing on one mouse at a time first, id 0.
+            results = results_list[0]
+            del results_list
         
-        if config_data['use_tracking_model']:
-            # threshold and clip mask frames from EM tracking results
-            results, tracking_init_mean, tracking_init_cov = set_tracking_model_parameters(results, **config_data)
+            if config_data['use_tracking_model']:
+                # threshold and clip mask frames from EM tracking results
+                results, tracking_init_mean, tracking_init_cov = set_tracking_model_parameters(results, **config_data)
+                extract_kwargs['tracking_init_mean'] = tracking_init_mean
+                extract_kwargs['tracking_init_cov'] = tracking_init_cov
+
+            # Offsetting frame chunk by CLI parameter defined option: chunk_overlap
+            frame_range = frame_range[offset:]
+
+            if h5_file is not None:
+                write_extracted_chunk_to_h5(h5_file, results, config_data, scalars, frame_range, offset)
+
+            # Create array for output movie with filtered video and cropped mouse on the top left
+            output_movie = make_output_movie(results, config_data, offset)
+
+            # Writing frame batch to mp4 file; batches must reach the pipe in order, and the first
+            # write opens it, so wait for the previous batch before queueing this one
+            if preview_future is not None:
+                video_pipe = preview_future.result()
+            preview_future = preview_pool.submit(write_frames_preview, output_mov_path, output_movie,
+                pipe=video_pipe, close_pipe=False, fps=config_data['fps'],
+                codec=config_data.get('preview_codec', 'h264'), frame_range=frame_range,
+                depth_max=config_data['max_height'], depth_min=config_data['min_height'],
+                progress_bar=config_data.get('progress_bar', False))
+
+            # the preview thread holds its own reference to output_movie; drop this batch's arrays
+            # now instead of keeping them alive alongside the next batch's
+            del results, output_movie
+
+        if preview_future is not None:
+            video_pipe = preview_future.result()
+
+    # Check if video is done writing. If not, wait.
+    if video_pipe is not None:
+        video_pipe.communicate()
 
-        # Offsetting frame chunk by CLI parameter defined option: chunk_overlap
-        frame_range = frame_range[offset:]
+def _extract_session(input_file, config_file, skip_extracted=False):
+    """
+    Extract a single session in a worker process of run_local_extract().
+
+    Args:
+    input_file (str): path to the depth file to extract
+    config_file (str): path to configuration file containing pre-configured extract and ROI
+    skip_extracted (bool): Whether to skip already extracted session.
 
-        if h5_file is not None:
-            write_extracted_chunk_to_h5(h5_file, results, config_data, scalars, frame_range, offset)
+    Returns:
+    (str): String indicating that the extracted is completed.
+    """
+    from moseq2_extract.gui import extract_command
 
-        # Create array for output movie with filtered video and cropped mouse on the top left
-        output_movie = make_output_movie(results, config_data, offset)
+    # sessions already run in parallel, so keep each one's OpenCV calls (and the zlib pool in
+    # _write_frames_direct, which follows OpenCV's thread count) from oversubscribing the cores
+    cv2.setNumThreads(1)
 
-        # Writing frame batch to mp4 file
-        video_pipe = write_frames_preview(output_mov_path, output_movie,
-            pipe=video_pipe, close_pipe=False, fps=config_data['fps'],
-            frame_range=list(frame_range),
-            depth_max=config_data['max_height'], depth_min=config_data['min_height'],
-            progress_bar=config_data.get('progress_bar', False))
+    return extract_command(input_file, None, config_file=config_file, skip=skip_extracted)
 
-    # Check if video is done writing. If not, wait.
-    if video_pipe is not None:
-        video_pipe.communicate()
 
-def run_local_extract(to_extract, config_file, skip_extracted=False):
+def run_local_extract(to_extract, config_file, skip_extracted=False, n_jobs=1):
     """
     Run the extract command on given list of sessions to extract on a local platform.
 
@@ -171,16 +301,38 @@ def run_local_extract(to_extract, config_file, skip_extracted=False):
     to_extract (list): list of paths to files to extract
     config_file (str): path to configuration file containing pre-configured extract and ROI
     skip_extracted (bool): Whether to skip already extracted session.
+    n_jobs (int): number of sessions to extract in parallel, each in its own process (capped at the number of cores).
 
     """
     from moseq2_extract.gui import extract_command
 
-    for ext in tqdm(to_extract, desc='Extracting Sessions'):
-        try:
-            extract_command(ext, None, config_file=config_file, skip=skip_extracted)
-        except Exception as e:
-            print('Unexpected error:', e)
-            print('could not extract', ext)
+    # each session runs OpenCV and h5 compression on one thread (see _extract_session), but it still has
+    # load and preview threads, a preview ffmpeg process (-threads 6) and any filter_threads, so a session
+    # can use more than one core; the cap only keeps the number of sessions at or below the core count
+    n_cores = cpu_count() or 1
+    if n_jobs is not None and n_jobs > n_cores:
+        warnings.warn(f'Requested {n_jobs} parallel sessions but only {n_cores} cores are available, '
+                      f'extracting {n_cores} sessions at a time.')
+    n_workers = min(n_jobs or 1, n_cores, len(to_extract))
+
+    if n_workers <= 1:
+        for ext in tqdm(to_extract, desc='Extracting Sessions'):
+            try:
+                extract_command(ext, None, config_file=config_file, skip=skip_extracted)
+            except Exception as e:
+                print('Unexpected error:', e)
+                print('could not extract', ext)
+        return
+
+    # sessions are independent (separate inputs and output folders), so extract them side by side
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(_extract_session, ext, config_file, skip_extracted): ext for ext in to_extract}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Extracting Sessions'):
+            try:
+                future.result()
+            except Exception as e:
+                print('Unexpected error:', e)
+                print('could not extract', futures[future])
 
 def run_slurm_extract(input_dir, to_extract, config_data, skip_extracted=False):
 
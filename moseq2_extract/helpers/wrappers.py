@@ -347,8 +347,9 @@ def extract_wrapper(input_file, output_dir, config_data, num_frames=None, skip=F
         'frame_batches': frame_batches
     }
 
-    # farm out the batches and write to an hdf5 file
-    with h5py.File(results_filename, 'w') as f:
+    # farm out the batches and write to an hdf5 file. A larger chunk cache keeps the partially
+    # written chunk at the end of each batch in memory until the next batch completes it
+    with h5py.File(results_filename, 'w', rdcc_nbytes=64 * 2**20, rdcc_nslots=10007) as f:
         # Write scalars, roi, acquisition metadata, etc. to h5 file
         create_extract_h5(**extraction_data,
                           h5_file=f,
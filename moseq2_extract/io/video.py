@@ -6,8 +6,10 @@ import os
 import cv2
 import tarfile
 import datetime
+import warnings
 import subprocess
 import numpy as np
+from functools import lru_cache
 from os.path import exists
 from tqdm.auto import tqdm
 import matplotlib.pyplot as plt
@@ -372,6 +374,68 @@ def read_mkv(filename, frames=range(0,), pixel_format='gray16be', movie_dtype='u
                        frames_is_timestamp=frames_is_timestamp, **kwargs)
 
 
+def _colormap_lut(cmap):
+    """
+    Tabulate a matplotlib colormap as 0-255 RGB values, with the colormap's "bad" color appended last.
+
+    Args:
+    cmap (matplotlib.colors.Colormap): colormap to tabulate
+
+    Returns:
+    lut (np.ndarray): (cmap.N + 1) x 3 array of RGB values scaled to 0-255
+    """
+
+    rgba = np.vstack((cmap(np.arange(cmap.N)), cmap(np.nan)))
+    return rgba[:, :3] * 255
+
+
+def _colormap_index(disp_img, n):
+    """
+    Map scaled depth values in [0, 1] to colormap table indices, the same way matplotlib colormaps do.
+
+    Args:
+    disp_img (np.ndarray): scaled frame, values clipped to [0, 1] (NaN allowed)
+    n (int): number of colors in the colormap
+
+    Returns:
+    idx (np.ndarray): integer table indices; NaNs point at the appended "bad" color
+    """
+
+    xa = disp_img * n
+    xa[xa == n] = n - 1
+    nans = np.isnan(xa)
+    if nans.any():
+        xa[nans] = n
+    return xa.astype('intp')
+
+
+# encoder arguments used when the preview codec is 'h264_nvenc' (h264 on the GPU)
+NVENC_ARGS = ['-vcodec', 'h264_nvenc', '-preset', 'p4', '-tune', 'll']
+
+
+@lru_cache(maxsize=None)
+def _nvenc_available(command, frame_bytes):
+    """
+    Check once per command whether an NVENC preview command can encode here, by piping it a single
+    blank frame and discarding the output. The encoder being listed by ffmpeg is not enough: it fails
+    to initialize without a usable GPU, or with options the driver does not support.
+
+    Args:
+    command (tuple): the ffmpeg preview command, without the output filename
+    frame_bytes (int): size in bytes of one raw input frame
+
+    Returns:
+    (bool): True if the command encoded the test frame.
+    """
+
+    try:
+        return subprocess.run(list(command) + ['-f', 'null', '-'], input=bytes(frame_bytes),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=30).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
 def write_frames_preview(filename, frames=np.empty((0,)), threads=6,
                          fps=30, pixel_format='rgb24',
                          codec='h264', slices=24, slicecrc=1,
@@ -388,7 +452,8 @@ def write_frames_preview(filename, frames=np.empty((0,)), threads=6,
     threads (int): number of threads to write video
     fps (int): frames per second
     pixel_format (str): format video color scheme
-    codec (str): ffmpeg encoding-writer method to use
+    codec (str): ffmpeg encoding-writer method to use; 'h264_nvenc' encodes on the GPU and falls back to 'h264'
+    when NVENC cannot be used
     slices (int): number of frame slices to write at a time.
     slicecrc (int): check integrity of slices
     frame_size (tuple): shape/dimensions of image.
@@ -421,37 +486,50 @@ def write_frames_preview(filename, frames=np.empty((0,)), threads=6,
     elif not frame_size and type(frames) is tuple:
         frame_size = '{0:d}x{1:d}'.format(frames[0], frames[1])
 
-    command = ['ffmpeg',
-               '-y',
-               '-loglevel', 'fatal',
-               '-threads', str(threads),
-               '-framerate', str(fps),
-               '-f', 'rawvideo',
-               '-s', frame_size,
-               '-pix_fmt', pixel_format,
-               '-i', '-',
-               '-an',
-               '-vcodec', codec,
-               '-slices', str(slices),
-               '-slicecrc', str(slicecrc),
-               '-r', str(fps),
-               filename]
+    input_args = ['ffmpeg',
+                  '-y',
+                  '-loglevel', 'fatal',
+                  '-threads', str(threads),
+                  '-framerate', str(fps),
+                  '-f', 'rawvideo',
+                  '-s', frame_size,
+                  '-pix_fmt', pixel_format,
+                  '-i', '-',
+                  '-an']
+    output_args = ['-slices', str(slices),
+                   '-slicecrc', str(slicecrc),
+                   '-r', str(fps)]
+
+    if codec == 'h264_nvenc':
+        command = input_args + NVENC_ARGS + output_args
+        # probe the exact command with one rgb24 frame before opening the pipe, since a failed
+        # encode would otherwise go unnoticed and leave no preview
+        width, height = map(int, frame_size.split('x'))
+        if (get_cmd or not pipe) and not _nvenc_available(tuple(command), 3 * width * height):
+            warnings.warn('h264_nvenc could not encode the preview movie, using h264 instead.')
+            command = input_args + ['-vcodec', 'h264'] + output_args
+    else:
+        command = input_args + ['-vcodec', codec] + output_args
+
+    command.append(filename)
 
     if get_cmd:
         return command
 
     if not pipe:
+        # a large stdin buffer turns the per-frame writes into few, large pipe writes
         pipe = subprocess.Popen(
-            command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            command, stdin=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 22)
 
-    # scale frames to appropriate depth ranges
+    # scale frames to appropriate depth ranges; the colormap is tabulated once and indexed
+    # per frame rather than evaluated through matplotlib for every frame
     use_cmap = plt.get_cmap(cmap)
+    cmap_lut = _colormap_lut(use_cmap)
     for i in tqdm(range(frames.shape[0]), disable=not progress_bar, desc=f"Writing frames to {filename}"):
-        disp_img = frames[i, :].copy().astype('float32')
+        disp_img = frames[i, :].astype('float32')
         disp_img = (disp_img-depth_min)/(depth_max-depth_min)
-        disp_img[disp_img < 0] = 0
-        disp_img[disp_img > 1] = 1
-        disp_img = np.delete(use_cmap(disp_img), 3, 2)*255
+        np.clip(disp_img, 0, 1, out=disp_img)
+        disp_img = cmap_lut[_colormap_index(disp_img, use_cmap.N)]
         if frame_range is not None:
             try:
                 cv2.putText(disp_img, str(frame_range[i]), txt_pos, font, 1, white, 2, cv2.LINE_AA)
@@ -460,7 +538,7 @@ def write_frames_preview(filename, frames=np.empty((0,)), threads=6,
                 # txt_pos is outside of the frame dimensions
                 print('Could not overlay frame number on preview on video.')
 
-        pipe.stdin.write(disp_img.astype('uint8').tostring())
+        pipe.stdin.write(disp_img.astype('uint8'))
 
     if close_pipe:
         pipe.communicate()
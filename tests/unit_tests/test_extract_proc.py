@@ -3,11 +3,65 @@ import re
 import cv2
 import glob
 import numpy as np
+import scipy.interpolate
 import numpy.testing as npt
-from unittest import TestCase
+from unittest import TestCase, mock
 from moseq2_extract.io.image import read_image
+from moseq2_extract.extract.extract import extract_chunk
 from moseq2_extract.extract.proc import get_roi, crop_and_rotate_frames, model_smoother, \
-    get_frame_features, compute_scalars, clean_frames, get_largest_cc, feature_hampel_filter
+    get_frame_features, compute_scalars, clean_frames, get_largest_cc, feature_hampel_filter, \
+    _fill_holes_cv2, _rect_decomposition, _fill_nans_nearest, _pack_features, _unpack_features
+
+def _reference_crop_and_rotate(frames, features, crop_size=(80, 80)):
+    # the crop crop_and_rotate_frames used to take from a zero border around the whole frame
+    cropped_frames = np.zeros((frames.shape[0], crop_size[0], crop_size[1]), frames.dtype)
+    win = (crop_size[0] // 2, crop_size[1] // 2 + 1)
+    border = (crop_size[1], crop_size[1], crop_size[0], crop_size[0])
+
+    for i in range(frames.shape[0]):
+        if np.any(np.isnan(features['centroid'][i])):
+            continue
+
+        use_frame = cv2.copyMakeBorder(frames[i], *border, cv2.BORDER_CONSTANT, 0)
+        rr = np.arange(features['centroid'][i, 1] - win[0], features['centroid'][i, 1] + win[1]).astype('int16')
+        cc = np.arange(features['centroid'][i, 0] - win[0], features['centroid'][i, 0] + win[1]).astype('int16')
+        rr = rr + crop_size[0]
+        cc = cc + crop_size[1]
+
+        if (np.any(rr >= use_frame.shape[0]) or np.any(rr < 1)
+                or np.any(cc >= use_frame.shape[1]) or np.any(cc < 1)):
+            continue
+
+        rot_mat = cv2.getRotationMatrix2D((crop_size[0] // 2, crop_size[1] // 2),
+                                          -np.rad2deg(features['orientation'][i]), 1)
+        cropped_frames[i] = cv2.warpAffine(use_frame[rr[0]:rr[-1], cc[0]:cc[-1]], rot_mat, (crop_size[0], crop_size[1]))
+
+    return cropped_frames
+
+
+def _reference_model_smoother(features, ll, clips):
+    # the float64, key-by-key interp1d and EMA loops model_smoother used to run
+    ave_ll = np.clip((ll.reshape(len(ll), -1).mean(1) - clips[0]) / (clips[1] - clips[0]), 0, 1)
+
+    xvec = np.arange(len(ave_ll))
+    for k, v in features.items():
+        v = v.reshape(len(v), -1)
+        for i in range(v.shape[1]):
+            nans = np.isnan(v[:, i])
+            if nans.any():
+                f = scipy.interpolate.interp1d(xvec[~nans], v[~nans, i], kind='nearest', fill_value='extrapolate')
+                v[nans, i] = f(xvec[nans])
+
+    for i in range(2, len(ave_ll)):
+        for k, v in features.items():
+            features[k][i] = (1 - ave_ll[i]) * v[i - 1] + ave_ll[i] * v[i]
+
+    for i in reversed(range(len(ave_ll) - 1)):
+        for k, v in features.items():
+            features[k][i] = (1 - ave_ll[i]) * v[i + 1] + ave_ll[i] * v[i]
+
+    return features
+
 
 class TestExtractProc(TestCase):
 
@@ -56,6 +110,20 @@ class TestExtractProc(TestCase):
             assert(np.min(frac_nonoverlap_roi1) < .2)
 
 
+    def test_fill_holes_cv2(self):
+
+        roi = np.zeros((50, 50), dtype='float32')
+        roi[10:40, 10:40] = 1
+        roi[20:30, 20:30] = 0
+
+        filled = _fill_holes_cv2(roi)
+
+        assert filled.dtype == bool
+        assert filled[10:40, 10:40].all()
+        assert not filled[:10].any() and not filled[40:].any()
+        assert not filled[:, :10].any() and not filled[:, 40:].any()
+
+
     def test_crop_and_rotate(self):
 
         fake_mouse = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (30, 20))
@@ -86,6 +154,22 @@ class TestExtractProc(TestCase):
 
         assert(percent_pixels_diff < .1)
 
+    def test_crop_and_rotate_edges(self):
+
+        # centroids near, on and past the frame edges, far outside it, and missing: the window is
+        # zero-padded only where it leaves the frame, which must match padding the whole frame
+        rng = np.random.default_rng(0)
+        edge_centroids = np.array([[40, 40], [2.5, 3.7], [0, 79], [79.9, 0.2], [-10.3, 50], [100, 41.5],
+                                   [50, -30], [-45, 40], [40, 125], [-200, 40], [np.nan, 40], [np.nan, np.nan]])
+        edge_features = {'centroid': edge_centroids,
+                         'orientation': rng.uniform(-np.pi, np.pi, len(edge_centroids))}
+
+        for dtype in ('float32', 'uint8'):
+            movie = rng.integers(1, 255, size=(len(edge_centroids), 80, 90)).astype(dtype)
+            for crop_size in ((80, 80), (50, 50)):
+                npt.assert_array_equal(crop_and_rotate_frames(movie, edge_features, crop_size=crop_size),
+                                       _reference_crop_and_rotate(movie, edge_features, crop_size=crop_size))
+
 
     def test_get_frame_features(self):
 
@@ -109,6 +193,38 @@ class TestExtractProc(TestCase):
                                       np.tile([30, 20], (fake_movie.shape[0], 1)), .1)
 
 
+    def test_get_frame_features_mouse_ids(self):
+
+        # a horizontal mouse walks right along the top while a vertical mouse walks left along the bottom
+        fake_movie = np.zeros((20, 100, 160), dtype='uint8')
+        for i in range(len(fake_movie)):
+            cv2.ellipse(fake_movie[i], (20 + 6 * i, 30), (12, 5), 0, 0, 360, 50, -1)
+            cv2.ellipse(fake_movie[i], (140 - 6 * i, 70), (12, 5), 90, 0, 360, 50, -1)
+
+        features_list, mask = get_frame_features(fake_movie, frame_threshold=10, number_of_mice=2)
+        horizontal = int(np.abs(features_list[0]['orientation'][0]) > 1)
+
+        npt.assert_almost_equal(features_list[horizontal]['centroid'][:, 1], 30, 1)
+        npt.assert_almost_equal(features_list[1 - horizontal]['centroid'][:, 1], 70, 1)
+        npt.assert_array_less(0, np.diff(features_list[horizontal]['centroid'][:, 0]))
+        npt.assert_array_less(np.diff(features_list[1 - horizontal]['centroid'][:, 0]), 0)
+
+        # the mice swap sides between two frames, so both contours are closest to the same
+        # previous centroid and the ids are kept by orientation
+        fake_movie = np.zeros((2, 80, 160), dtype='uint8')
+        cv2.ellipse(fake_movie[0], (40, 40), (12, 5), 0, 0, 360, 50, -1)
+        cv2.ellipse(fake_movie[0], (120, 40), (12, 5), 90, 0, 360, 50, -1)
+        cv2.ellipse(fake_movie[1], (70, 40), (12, 5), 0, 0, 360, 50, -1)
+        cv2.ellipse(fake_movie[1], (30, 40), (12, 5), 90, 0, 360, 50, -1)
+
+        features_list, mask = get_frame_features(fake_movie, frame_threshold=10, number_of_mice=2)
+        horizontal = int(np.abs(features_list[0]['orientation'][0]) > 1)
+
+        npt.assert_almost_equal(features_list[horizontal]['centroid'][:, 0], [40, 70], 1)
+        npt.assert_almost_equal(features_list[1 - horizontal]['centroid'][:, 0], [120, 30], 1)
+        npt.assert_almost_equal(features_list[horizontal]['orientation'], 0, 2)
+
+
     def test_compute_scalars(self):
 
         fake_mouse = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (30, 20))
@@ -175,6 +291,39 @@ class TestExtractProc(TestCase):
         fake_movie = np.tile(fake_mouse, (100, 1, 1))
         cleaned_fake_movie = clean_frames(fake_movie, prefilter_time=(3,))
 
+        # large tail filters are run as a union of rectangles and must match OpenCV's opening
+        rng = np.random.default_rng(0)
+        noisy_movie = (np.tile(fake_mouse, (10, 1, 1)) + rng.integers(0, 30, (10, 80, 80))).astype('uint8')
+        noisy_movie[:, 5:15, 60:75] = 200
+
+        strels = [cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15)),
+                  cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (16, 16)),
+                  cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (21, 17)),
+                  cv2.getStructuringElement(cv2.MORPH_CROSS, (15, 15))]
+
+        for strel in strels:
+            assert _rect_decomposition(strel) is not None
+            cleaned_fake_movie = clean_frames(noisy_movie, prefilter_space=None, strel_tail=strel, iters_tail=1)
+            reference = np.array([cv2.morphologyEx(frame, cv2.MORPH_OPEN, strel) for frame in noisy_movie])
+            npt.assert_array_equal(cleaned_fake_movie, reference)
+
+    def test_extract_chunk_filter_threads(self):
+
+        rng = np.random.default_rng(0)
+        tmp_image = np.zeros((100, 100), dtype='uint8')
+        cv2.ellipse(tmp_image, (50, 50), (15, 10), 30, 0, 360, 40, -1)
+        fake_movie = np.tile(tmp_image, (20, 1, 1)) + rng.integers(0, 30, (20, 100, 100)).astype('uint8')
+
+        # filter_threads is handed to clean_frames, and the threaded filters match the serial ones
+        with mock.patch('moseq2_extract.extract.extract.clean_frames', wraps=clean_frames) as cleaner:
+            serial = extract_chunk(fake_movie, progress_bar=False, number_of_mice=1, iters_min=1)
+            threaded = extract_chunk(fake_movie, progress_bar=False, number_of_mice=1, iters_min=1,
+                                     filter_threads=2)
+
+        assert [call.kwargs['n_jobs'] for call in cleaner.call_args_list] == [1, 2]
+        npt.assert_array_equal(serial[0]['depth_frames'], threaded[0]['depth_frames'])
+        npt.assert_array_equal(serial[0]['mask_frames'], threaded[0]['mask_frames'])
+
     def test_feature_hampel_filter(self):
 
         fake_mouse = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (30, 20))
@@ -200,6 +349,59 @@ class TestExtractProc(TestCase):
         for k in smoothed_features.keys():
             assert smoothed_features[k].all() == fake_features[k].all()
 
+    def test_fill_nans_nearest(self):
+
+        rng = np.random.default_rng(0)
+        v = rng.normal(size=(50, 7))
+        v[:6, 0] = np.nan  # leading
+        v[-4:, 1] = np.nan  # trailing
+        v[:, 2] = np.nan  # all missing
+        v[:, 3] = np.nan
+        v[20, 3] = 1  # a single valid frame
+        v[rng.random(50) < .4, 4] = np.nan
+        v[np.isnan(v[:, 4]), 5] = np.nan  # same missing frames as column 4
+        v[[11, 13, 14, 30, 31], 6] = np.nan  # equidistant gaps tie to the earlier frame
+
+        filled = v.copy()
+        _fill_nans_nearest(filled)
+
+        xvec = np.arange(len(v))
+        for i in range(v.shape[1]):
+            valid = ~np.isnan(v[:, i])
+            if not valid.any():
+                assert np.all(np.isnan(filled[:, i]))
+                continue
+            f = scipy.interpolate.interp1d(xvec[valid], v[valid, i], kind='nearest', fill_value='extrapolate')
+            npt.assert_array_equal(filled[:, i], f(xvec))
+
+    def test_pack_features(self):
+
+        rng = np.random.default_rng(0)
+        features = {
+            'centroid': rng.normal(size=(30, 2)),
+            'orientation': rng.normal(size=(30,)),
+            'axis_length': rng.normal(size=(30, 2))
+        }
+        original = {k: v.copy() for k, v in features.items()}
+
+        for dtype in (None, 'float32'):
+            mat, slices = _pack_features(features, dtype=dtype)
+            assert mat.shape == (30, 5)
+            assert mat.dtype == (np.float64 if dtype is None else np.float32)
+
+            arrays = dict(features)
+            unpacked = _unpack_features(mat * 2, slices, features)
+
+            # written back into the caller's arrays, keeping their keys, shapes and dtypes
+            assert unpacked is features
+            assert list(unpacked.keys()) == list(original.keys())
+            for k, v in unpacked.items():
+                assert v is arrays[k]
+                assert v.shape == original[k].shape
+                assert v.dtype == original[k].dtype
+                npt.assert_allclose(v, original[k] * 2, rtol=1e-6)
+                v[...] = original[k]
+
     def test_model_smoother(self):
 
         fake_mouse = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (30, 20))
@@ -231,3 +433,25 @@ class TestExtractProc(TestCase):
 
         smoothed_feats = model_smoother(fake_features, ll=test_ll, clips=(-300, -125))
         assert smoothed_feats == fake_features
+
+    def test_model_smoother_reference(self):
+
+        # the packed float32 smoother stays within float32 rounding of the float64 reference
+        rng = np.random.default_rng(0)
+        features = {
+            'centroid': rng.normal(40, 5, size=(500, 2)),
+            'orientation': rng.normal(0, 1, size=(500,)),
+            'axis_length': rng.normal(10, 2, size=(500, 2))
+        }
+        for v in features.values():
+            v[rng.random(500) < .1] = np.nan
+        features['orientation'][:5] = np.nan
+        features['axis_length'][-5:] = np.nan
+
+        test_ll = rng.normal(-200, 60, size=(500, 8, 8))
+        reference = _reference_model_smoother({k: v.copy() for k, v in features.items()}, test_ll, (-300, -150))
+        smoothed_feats = model_smoother(features, ll=test_ll, clips=(-300, -150))
+
+        for k, v in smoothed_feats.items():
+            assert v.dtype == reference[k].dtype
+            npt.assert_allclose(v, reference[k], rtol=1e-6, atol=1e-6)
@@ -1,13 +1,15 @@
 import os
 import sys
 import shutil
+import h5py
 import tarfile
+import numpy as np
 import ruamel.yaml as yaml
 from unittest import TestCase
 from moseq2_extract.util import load_metadata
 from ..integration_tests.test_cli import write_fake_movie
 from moseq2_extract.helpers.data import load_extraction_meta_from_h5s, check_completion_status, \
-                build_manifest, copy_manifest_results, handle_extract_metadata, build_index_dict
+                build_manifest, copy_manifest_results, handle_extract_metadata, build_index_dict, create_extract_h5
 
 class TestHelperData(TestCase):
 
@@ -117,4 +119,26 @@ class TestHelperData(TestCase):
         assert len(timestamps.shape) == 1
         assert tar is None
 
-        os.remove(tmp_file)
\ No newline at end of file
+        os.remove(tmp_file)
+
+    def test_create_extract_h5_compression(self):
+
+        out_file = 'data/test_create_extract.h5'
+        nframes = 10
+        config_data = {'crop_size': (80, 80), 'frame_dtype': 'uint8', 'use_tracking_model': False,
+                       'flip_classifier': None, 'true_depth': 673.0}
+        status_dict = {'uuid': 'test', 'parameters': {}}
+        image = np.zeros((20, 20), dtype='float32')
+
+        # the gzip level defaults to h5py's level 4 unless it is set in the config
+        for level, expected in ((None, 4), (1, 1), (9, 9)):
+            if level is not None:
+                config_data['frame_compression_level'] = level
+            with h5py.File(out_file, 'w') as f:
+                create_extract_h5(f, {}, config_data, status_dict, {}, nframes, image, image,
+                                  image[None], 0, nframes)
+                for key in ('frames', 'frames_mask'):
+                    assert f[key].compression == 'gzip'
+                    assert f[key].compression_opts == expected
+
+        os.remove(out_file)
@@ -1,18 +1,31 @@
+import io
 import os
 import cv2
 import h5py
 import uuid
 import shutil
+import threading
+import contextlib
 import numpy as np
+import numpy.testing as npt
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import ruamel.yaml as yaml
-from unittest import TestCase
+from unittest import TestCase, mock
 from moseq2_extract.io.image import read_image
 from moseq2_extract.helpers.data import create_extract_h5
 from ..integration_tests.test_cli import write_fake_movie
 from moseq2_extract.gui import generate_config_command, download_flip_command
 from moseq2_extract.util import scalar_attributes, gen_batch_sequence, load_metadata
-from moseq2_extract.helpers.extract import run_local_extract, process_extract_batches, write_extracted_chunk_to_h5
+from moseq2_extract.helpers.extract import run_local_extract, process_extract_batches, write_extracted_chunk_to_h5, \
+    _write_frames_direct
+
+def _fake_extract_command(input_file, output_dir, config_file=None, skip=False):
+    # stands in for gui.extract_command in the session worker processes
+    if os.path.basename(input_file) == 'bad_session':
+        raise ValueError('corrupt depth file')
+    with open(f'{input_file}.done', 'w') as f:
+        f.write(str(os.getpid()))
 
 class TestHelperExtract(TestCase):
 
@@ -41,6 +54,80 @@ class TestHelperExtract(TestCase):
         assert os.path.exists(out_file)
         os.remove(out_file)
 
+    def test_write_extracted_chunk_to_h5_batches(self):
+
+        out_file = 'data/test_out_batches.h5'
+        nframes = 103
+        chunk_overlap = 5
+        scalars = ['speed']
+        config_data = {'flip_classifier': False}
+
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 255, size=(nframes, 10, 10), dtype='uint8')
+        masks = rng.normal(size=(nframes, 10, 10)).astype('float32')
+
+        def create_datasets(f, **kwargs):
+            f.create_dataset('scalars/speed', (nframes,), 'float32', compression='gzip')
+            f.create_dataset('frames', (nframes, 10, 10), 'uint8', chunks=(8, 10, 10),
+                             compression='gzip', **kwargs)
+            f.create_dataset('frames_mask', (nframes, 10, 10), 'float32', chunks=(8, 10, 10),
+                             compression='gzip', **kwargs)
+
+        for kwargs in ({}, {'compression_opts': 1}, {'shuffle': True}):
+            with h5py.File(out_file, 'w') as f:
+                create_datasets(f, **kwargs)
+                reference = f.create_group('reference')
+                create_datasets(reference, **kwargs)
+
+                # overlapping batches that start and stop partway through chunks, as in process_extract_batches
+                for i, frame_range in enumerate(gen_batch_sequence(nframes, 20, chunk_overlap)):
+                    offset = chunk_overlap if i > 0 else 0
+                    # the overlap is extracted twice, so its frames differ from the ones kept
+                    batch = slice(frame_range.start, frame_range.stop)
+                    results = {'depth_frames': frames[batch] // 2,
+                               'mask_frames': masks[batch] + 1,
+                               'scalars': {'speed': np.arange(batch.start, batch.stop, dtype='float32')}}
+                    results['depth_frames'][offset:] = frames[batch][offset:]
+                    results['mask_frames'][offset:] = masks[batch][offset:]
+
+                    write_extracted_chunk_to_h5(f, results, config_data, scalars, frame_range[offset:], offset)
+
+                    kept = slice(frame_range[offset], frame_range.stop)
+                    reference['frames'][kept] = results['depth_frames'][offset:]
+                    reference['frames_mask'][kept] = results['mask_frames'][offset:]
+
+            with h5py.File(out_file, 'r') as f:
+                for key in ('frames', 'frames_mask'):
+                    npt.assert_array_equal(f[key][...], f['reference'][key][...])
+                npt.assert_array_equal(f['frames'][...], frames)
+                npt.assert_array_equal(f['frames_mask'][...], masks)
+                npt.assert_array_equal(f['scalars/speed'][...], np.arange(nframes))
+
+        os.remove(out_file)
+
+    def test_write_frames_direct_threads(self):
+
+        out_file = 'data/test_out_direct.h5'
+        frames = np.random.default_rng(0).integers(0, 255, size=(64, 10, 10), dtype='uint8')
+        pool = 'moseq2_extract.helpers.extract.ThreadPoolExecutor'
+
+        # the zlib pool is capped by OpenCV's thread count; session workers set it to 1 and compress serially
+        for cv_threads, expected_workers in ((1, None), (2, 2), (8, 4)):
+            with h5py.File(out_file, 'w') as f:
+                f.create_dataset('frames', frames.shape, 'uint8', chunks=(8, 10, 10), compression='gzip')
+                with mock.patch('moseq2_extract.helpers.extract.cpu_count', return_value=4), \
+                     mock.patch('cv2.getNumThreads', return_value=cv_threads), \
+                     mock.patch(pool, wraps=ThreadPoolExecutor) as executor:
+                    _write_frames_direct(f['frames'], slice(0, 64), frames)
+
+                if expected_workers is None:
+                    executor.assert_not_called()
+                else:
+                    executor.assert_called_once_with(max_workers=expected_workers)
+                npt.assert_array_equal(f['frames'][...], frames)
+
+        os.remove(out_file)
+
     def test_process_extract_batches(self):
 
         output_dir = 'data/'
@@ -113,6 +200,83 @@ class TestHelperExtract(TestCase):
         shutil.rmtree(data_path)
         shutil.rmtree('data/flip/')
 
+    def test_process_extract_batches_threads(self):
+
+        frame_batches = list(gen_batch_sequence(70, 20, 5))
+        calls = []
+        loaded = {}
+
+        class FakePipe:
+            def communicate(self):
+                calls.append('communicate')
+
+        def fake_load_movie_data(input_file, frame_range, frame_size=None, **kwargs):
+            loaded.setdefault(frame_range.start, threading.Event()).set()
+            if fail_load is not None and frame_range.start == fail_load:
+                raise IOError('truncated depth file')
+            calls.append(('load', frame_range.start))
+            return np.full((len(frame_range), 4, 4), frame_range.start, dtype='uint8')
+
+        def fake_extract_chunk(chunk=None, tracking_init_mean=None, **kwargs):
+            start = int(chunk[0, 0, 0])
+            calls.append(('extract', start, tracking_init_mean))
+            # the next batch is read on the loader thread while this one is extracted
+            next_starts = [b.start for b in frame_batches if b.start > start]
+            if next_starts:
+                assert loaded.setdefault(next_starts[0], threading.Event()).wait(5)
+            return [{'chunk': chunk, 'depth_frames': chunk, 'mask_frames': chunk, 'scalars': {}, 'flips': None}]
+
+        def fake_set_tracking_model_parameters(results, **kwargs):
+            start = int(results['chunk'][0, 0, 0])
+            return results, f'mean_{start}', f'cov_{start}'
+
+        def fake_write_frames_preview(filename, frames, pipe=None, frame_range=None, **kwargs):
+            if fail_preview is not None and frame_range[0] == fail_preview:
+                raise BrokenPipeError('ffmpeg exited')
+            calls.append(('preview', frame_range.start, frame_range.stop, pipe is not None))
+            return pipe or FakePipe()
+
+        def run():
+            config_data = {'chunk_overlap': 5, 'use_tracking_model': True, 'tracking_init_mean': 'mean_init',
+                           'fps': 30, 'max_height': 100, 'min_height': 10}
+            calls.clear()
+            loaded.clear()
+            with mock.patch('moseq2_extract.helpers.extract.load_movie_data', fake_load_movie_data), \
+                    mock.patch('moseq2_extract.helpers.extract.extract_chunk', fake_extract_chunk), \
+                    mock.patch('moseq2_extract.helpers.extract.set_tracking_model_parameters',
+                               fake_set_tracking_model_parameters), \
+                    mock.patch('moseq2_extract.helpers.extract.make_output_movie',
+                               lambda results, config_data, offset=0: results['depth_frames'][offset:]), \
+                    mock.patch('moseq2_extract.helpers.extract.write_frames_preview', fake_write_frames_preview):
+                process_extract_batches('depth.dat', config_data, np.zeros((4, 4)), None, frame_batches, {}, 'out.mp4')
+
+        fail_load, fail_preview = None, None
+        run()
+
+        starts = [b.start for b in frame_batches]
+        assert [c for c in calls if c[0] == 'load'] == [('load', start) for start in starts]
+
+        # each batch is extracted with the tracking init left by the previous one
+        init_means = ['mean_init'] + [f'mean_{start}' for start in starts[:-1]]
+        assert [c for c in calls if c[0] == 'extract'] == [('extract', start, mean)
+                                                            for start, mean in zip(starts, init_means)]
+
+        # previews reach the pipe in order, without the overlap, and only the first one opens it
+        previews = [('preview', b.start + (5 if i > 0 else 0), b.stop, i > 0) for i, b in enumerate(frame_batches)]
+        assert [c for c in calls if c[0] == 'preview'] == previews
+        assert calls[-1] == 'communicate'
+
+        # errors on the loader and preview threads reach the caller
+        fail_load, fail_preview = starts[2], None
+        with self.assertRaises(IOError):
+            run()
+        assert ('extract', starts[2], init_means[2]) not in calls
+
+        fail_load, fail_preview = None, starts[1] + 5
+        with self.assertRaises(BrokenPipeError):
+            run()
+        assert 'communicate' not in calls
+
     def test_run_local_extract(self):
 
         config_path = 'data/test_local_ex_config.yaml'
@@ -134,4 +298,34 @@ class TestHelperExtract(TestCase):
 
         run_local_extract([str(data_path)], params, prefix)
         os.remove(config_path)
-        shutil.rmtree(data_dir)
\ No newline at end of file
+        shutil.rmtree(data_dir)
+
+    def test_run_local_extract_parallel(self):
+
+        data_dir = 'data/test_parallel_sessions/'
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+        sessions = [os.path.join(data_dir, name) for name in ('session_a', 'bad_session', 'session_b', 'session_c')]
+
+        stdout = io.StringIO()
+        with mock.patch('moseq2_extract.gui.extract_command', _fake_extract_command), \
+                mock.patch('moseq2_extract.helpers.extract.cpu_count', return_value=2), \
+                contextlib.redirect_stdout(stdout):
+            # more sessions requested than cores: warned and capped
+            with self.assertWarns(UserWarning):
+                run_local_extract(sessions, 'config.yaml', n_jobs=4)
+
+        # the failing session is reported by name, the others are still extracted in worker processes
+        assert stdout.getvalue().count('could not extract') == 1
+        assert f'could not extract {sessions[1]}' in stdout.getvalue()
+        assert 'corrupt depth file' in stdout.getvalue()
+
+        for session in sessions:
+            if session == sessions[1]:
+                assert not os.path.exists(f'{session}.done')
+            else:
+                with open(f'{session}.done') as f:
+                    assert int(f.read()) != os.getpid()
+
+        shutil.rmtree(data_dir)
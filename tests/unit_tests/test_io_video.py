@@ -1,10 +1,10 @@
 import os
 import numpy as np
 import numpy.testing as npt
-from unittest import TestCase
+from unittest import TestCase, mock
 from moseq2_extract.io.video import read_frames_raw, get_raw_info,\
     read_frames, write_frames, get_video_info, write_frames_preview,\
-    get_movie_info, load_movie_data, load_timestamps_from_movie, read_mkv
+    get_movie_info, load_movie_data, load_timestamps_from_movie, read_mkv, NVENC_ARGS
 
 class TestVideoIO(TestCase):
     def test_read_frames_raw(self):
@@ -59,6 +59,34 @@ class TestVideoIO(TestCase):
         write_frames_preview(data_path, test_data, fps=30, frame_range=range(len(test_data)))
         os.remove(data_path)
 
+    def test_write_frames_preview_codec(self):
+
+        data_path = 'data/fake_preview_depth.mp4'
+        test_data = np.zeros((10, 80, 80), dtype='uint8')
+
+        def codec_args(command):
+            i = command.index('-vcodec')
+            return command[i:command.index('-slices')]
+
+        with mock.patch('moseq2_extract.io.video._nvenc_available', return_value=True) as probe:
+            # NVENC is only used when asked for
+            command = write_frames_preview(data_path, test_data, get_cmd=True)
+            assert codec_args(command) == ['-vcodec', 'h264']
+            probe.assert_not_called()
+
+            command = write_frames_preview(data_path, test_data, codec='h264_nvenc', get_cmd=True)
+            assert codec_args(command) == NVENC_ARGS
+            assert command[-1] == data_path
+
+            # the probe runs the same command, minus the output file, on one rgb24 frame
+            probe.assert_called_once_with(tuple(command[:-1]), 80 * 80 * 3)
+
+        with mock.patch('moseq2_extract.io.video._nvenc_available', return_value=False):
+            with self.assertWarns(UserWarning):
+                command = write_frames_preview(data_path, test_data, codec='h264_nvenc', get_cmd=True)
+            assert codec_args(command) == ['-vcodec', 'h264']
+            assert command == write_frames_preview(data_path, test_data, get_cmd=True)
+
     def test_get_movie_info(self):
 
         avi_path = 'data/fake_movie_info.avi'